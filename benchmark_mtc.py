@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# headless benchmarks for the realtime MTC code
+#
+# the sender (generate_mtc.start_mtc) and the playback loop
+# (mtc_to_midi.listen) run against loopback ports, every message is
+# timestamped as it arrives, and the timing is compared with where it
+# should have been
+#
+# each frame rate runs in a fresh process so runs can't disturb each other
+# results can be saved as JSON and compared with an earlier run
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import click
+import numpy
+from timecode import Timecode
+
+import generate_mtc
+import mtc_to_midi
+import transport
+from tools import exact_frame_rate
+
+START = '01:00:00:00'
+
+# these are compared between runs, all of them are better when smaller
+# except throughput
+KEY_METRICS = [
+    ('sender', 'interval_jitter_us', 'p99'),
+    ('sender', 'lateness_us', 'p99'),
+    ('sender', 'lock_time_ms', 'mean'),
+    ('sender', 'cpu_percent', None),
+    ('sender', 'throughput_per_s', None),
+    ('playback', 'dispatch_error_ms', 'p50'),
+    ('playback', 'dispatch_error_ms', 'max'),
+    ('playback', 'cpu_percent', None),
+]
+
+
+def percentiles(values, scale=1):
+  values = numpy.abs(numpy.asarray(values, dtype=numpy.float64)) / scale
+  if len(values) == 0:
+    return {}
+  return {
+      'mean': float(values.mean()),
+      'p50': float(numpy.percentile(values, 50)),
+      'p90': float(numpy.percentile(values, 90)),
+      'p99': float(numpy.percentile(values, 99)),
+      'max': float(values.max()),
+  }
+
+
+def lock_times(arrivals, step_ns=37_000_000):
+  # a receiver joining at any moment has to wait for the next piece 0
+  # and then for the piece 7 that completes it
+  # arrivals are (timestamp, piece) for every quarter frame
+  times = numpy.array([t for t, piece in arrivals], dtype=numpy.int64)
+  pieces = numpy.array([piece for t, piece in arrivals])
+  starts = numpy.flatnonzero(pieces[:-7] == 0)
+  complete = starts[pieces[starts + 7] == 7]
+  locks = []
+  for join in range(int(times[0]), int(times[complete[-1]]), step_ns):
+    first = complete[numpy.searchsorted(times[complete], join)]
+    locks.append(times[first + 7] - join)
+  return locks
+
+
+@contextlib.contextmanager
+def cpu_meter(result):
+  # process cpu time over wall time, so more than 100 means more than one core
+  wall = time.perf_counter()
+  cpu = time.process_time()
+  yield
+  result['cpu_percent'] = 100 * (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+@contextlib.contextmanager
+def thread_cpu_meter(result, thread):
+  # cpu time of just thread over wall time, for when other work shares the process
+  clock_id = time.pthread_getcpuclockid(thread.ident)
+  wall = time.perf_counter()
+  cpu = time.clock_gettime(clock_id)
+  yield
+  result['cpu_percent'] = 100 * (time.clock_gettime(clock_id) - cpu) / (time.perf_counter() - wall)
+
+
+def bench_sender(fps, seconds):
+  arrivals = []
+  transport.open_input('loopback-sender', lambda data, timestamp: arrivals.append((timestamp, bytes(data))))
+  outport = transport.open_output('loopback-sender')
+  result = {}
+  with cpu_meter(result), contextlib.redirect_stdout(io.StringIO()):
+    scheduler = generate_mtc.start_mtc(outport, fps, START, seconds)
+
+  quarter_ns = 10**9 / exact_frame_rate(float(fps)) / 4
+  quarter_frames = [(t, data[1] >> 4) for t, data in arrivals if data[0] == 0xf1]
+  intervals = numpy.diff([t for t, piece in quarter_frames])
+  lateness = scheduler.stats['quarter frame'].summary()
+  result.update({
+      'messages': len(arrivals),
+      'throughput_per_s': len(arrivals) / seconds,
+      'interval_jitter_us': percentiles(intervals - float(quarter_ns), 1000),
+      'lateness_us': {k[:-3]: lateness[k] for k in ('mean_us', 'p50_us', 'p99_us', 'max_us')},
+      'lock_time_ms': percentiles(lock_times(quarter_frames), 1e6),
+  })
+  return result
+
+
+def bench_playback(fps, seconds, every=5):
+  # one event every few frames from a second in, then see when each one comes out
+  # each event says which it is with its note and velocity, i % 128 and i // 128 + 1
+  start = Timecode(fps, START)
+  event_frames = list(range(start.frames + round(float(fps)), start.frames + round(float(fps) * (seconds - 0.5)), every))
+  with tempfile.NamedTemporaryFile('w', suffix='.mtc2midi', delete=False) as f:
+    for i, frames in enumerate(event_frames):
+      f.write(f'{Timecode(fps, frames=frames)} 90,{i % 128:02X},{i // 128 + 1:02X}\n')
+    config = f.name
+
+  arrivals = []
+  sent = []
+  transport.open_input('loopback-mtc', lambda data, timestamp: sent.append((timestamp, bytes(data))))
+  transport.open_input('loopback-midi', lambda data, timestamp: arrivals.append((timestamp, bytes(data))))
+  result = {}
+  with contextlib.redirect_stdout(io.StringIO()):
+    # listen never returns, the process is thrown away afterwards
+    listener = threading.Thread(target=mtc_to_midi.listen, args=('loopback-mtc', 'loopback-midi', config, False, 'loopback'), daemon=True)
+    listener.start()
+    time.sleep(0.2)
+    # the sender runs in this thread, and only the listener's cpu counts
+    with thread_cpu_meter(result, listener):
+      generate_mtc.start_mtc(transport.open_output('loopback-mtc'), fps, START, seconds)
+  os.remove(config)
+  if os.path.exists(mtc_to_midi.cue_file(config)):
+    os.remove(mtc_to_midi.cue_file(config))
+
+  # the quarter frames mark out the grid the timecode runs on, fitted here
+  # rather than trusting any one message to have gone out on time
+  frame_ns = float(10**9 / exact_frame_rate(float(fps)))
+  quarter_frames = numpy.array([t for t, data in sent if data[0] == 0xf1], dtype=numpy.float64)
+  origin = float(numpy.median(quarter_frames - numpy.arange(len(quarter_frames)) * frame_ns / 4))
+  errors = []
+  for t, data in arrivals:
+    due = origin + (event_frames[(data[2] - 1) * 128 + data[1]] - start.frames) * frame_ns
+    errors.append(t - due)
+  result.update({
+      'events': len(event_frames),
+      'dispatched': len(arrivals),
+      'dispatch_error_ms': percentiles(errors, 1e6),
+      'mean_signed_error_ms': float(numpy.mean(errors) / 1e6) if errors else None,
+      'stages_us': {stage: stats.summary() for stage, stats in mtc_to_midi.stats.items()},
+  })
+  return result
+
+
+def run_benchmarks(fps, seconds, results):
+  results.put({'sender': bench_sender(fps, seconds), 'playback': bench_playback(fps, seconds)})
+
+
+def run_isolated(fps, seconds):
+  context = multiprocessing.get_context('spawn')
+  results = context.Queue()
+  process = context.Process(target=run_benchmarks, args=(fps, seconds, results))
+  process.start()
+  result = results.get()
+  process.terminate()
+  process.join()
+  return result
+
+
+def metric(run, bench, name, key):
+  value = run.get(bench, {}).get(name)
+  return value.get(key) if key is not None and value is not None else value
+
+
+def print_report(results, previous=None):
+  for fps, run in results['runs'].items():
+    print(f'{fps}fps')
+    for bench, name, key in KEY_METRICS:
+      value = metric(run, bench, name, key)
+      if value is None:
+        continue
+      label = f'{bench} {name}' + (f' {key}' if key else '')
+      line = f'  {label:<40} {value:>12.3f}'
+      old = metric(previous['runs'].get(fps, {}), bench, name, key) if previous else None
+      if old:
+        line += f'   was {old:>12.3f}  ({100 * (value - old) / old:+.1f}%)'
+      print(line)
+
+
+@click.command()
+@click.option('--fps', '-f', multiple=True, default=['24', '25', '29.97', '30'], help='frame rates to run, defaults to 24, 25, 29.97 and 30')
+@click.option('--duration', '-d', default=5.0, help='seconds to run each benchmark, defaults to 5')
+@click.option('--output', '-o', help='save the results to this JSON file')
+@click.option('--compare', '-c', help='JSON results from an earlier run to compare against')
+def main(fps, duration, output, compare):
+  results = {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'backend': 'loopback',
+      'duration': duration,
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'runs': {},
+  }
+  for rate in fps:
+    print(f'running {rate}fps for {duration}s ...')
+    results['runs'][rate] = run_isolated(rate, duration)
+
+  previous = None
+  if compare is not None:
+    with open(compare) as f:
+      previous = json.load(f)
+  print_report(results, previous)
+
+  if output is not None:
+    with open(output, 'w') as f:
+      json.dump(results, f, indent=2)
+    print(f'saved {output}')
+
+
+if __name__ == '__main__':
+  main()
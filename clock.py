@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# clocks for the mtc generator
+#
+# now() counts nanoseconds on whatever timeline the generator should follow
+# the monotonic clock is just perf_counter_ns, the others follow something
+# outside the computer (an audio interface's sample clock, or timecode coming
+# in) through a Pll, which turns the occasional, jittery readings of that
+# reference into a smooth line against perf_counter_ns
+#
+# the chase clocks count from 00:00:00:00 of the incoming timecode, so the
+# generator can tell where to start as well as how fast to go
+
+import threading
+import time
+
+import numpy
+from timecode import Timecode
+
+import transport
+from ltc_decode import bits_to_frames, crossings, transitions_to_bits
+from tools import MTC_RATES, QuarterFrameDecoder, exact_frame_rate, mtc_frame_number
+
+# sounddevice is only needed for the audio clocks
+try:
+  import sounddevice as sd
+except ImportError:
+  sd = None
+
+
+def frame_ns(fps):
+  # nanoseconds per frame as an exact fraction
+  return 10**9 / exact_frame_rate(float(fps))
+
+
+class Pll:
+  # follows a reference timeline against perf_counter_ns
+  # each reading moves the phase by phase_gain of the error and the rate by
+  # rate_gain of it, so jitter in the readings is smoothed away while steady
+  # drift is learned
+  # an error bigger than resync_ns is a jump (a relocate or a dropout) and is
+  # taken all at once
+  def __init__(self, phase_gain=0.05, rate_gain=0.001, resync_ns=100_000_000):
+    self.phase_gain = phase_gain
+    self.rate_gain = rate_gain
+    self.resync_ns = resync_ns
+    self.local = None
+    self.reference = 0
+    self.rate = 1.0
+    self.error = 0
+    self.updates = 0
+    self.resyncs = 0
+    self.lock = threading.Lock()
+
+  def estimate(self, local):
+    return self.reference + (local - self.local) * self.rate
+
+  def local_time(self, reference):
+    # the other way round, when the reference timeline will reach reference
+    return self.local + (reference - self.reference) / self.rate
+
+  def update(self, local, reference):
+    with self.lock:
+      self.updates += 1
+      if self.local is None:
+        self.local, self.reference = local, reference
+        return
+      if local <= self.local:
+        return
+      predicted = self.estimate(local)
+      self.error = reference - predicted
+      if abs(self.error) > self.resync_ns:
+        self.local, self.reference = local, reference
+        self.resyncs += 1
+        return
+      # the line is moved up to this reading so the numbers stay small
+      self.rate += self.rate_gain * self.error / (local - self.local)
+      self.local, self.reference = local, predicted + self.phase_gain * self.error
+
+  def drift_ppm(self):
+    return (self.rate - 1) * 1e6
+
+
+class MonotonicClock:
+  chase = False
+
+  def now(self):
+    return time.perf_counter_ns()
+
+  def wait_for_lock(self):
+    pass
+
+  def resyncs(self):
+    return 0
+
+  def status(self):
+    return 'monotonic clock'
+
+  def close(self):
+    pass
+
+
+class PllClock:
+  # a clock that follows readings fed to its pll
+  chase = False
+
+  def __init__(self, **pll_options):
+    self.pll = Pll(**pll_options)
+
+  def now(self):
+    with self.pll.lock:
+      return round(self.pll.estimate(time.perf_counter_ns()))
+
+  def wait_for_lock(self, updates=8):
+    # a few readings are needed before the rate means anything
+    while self.pll.updates < updates:
+      time.sleep(0.01)
+
+  def resyncs(self):
+    return self.pll.resyncs
+
+  def status(self):
+    return (f'{self.name}: drift {self.pll.drift_ppm():+.1f}ppm  last error {self.pll.error / 1000:+.0f}us  '
+            f'{self.pll.updates} readings  {self.pll.resyncs} resyncs')
+
+
+class AudioClock(PllClock):
+  # counts the samples coming in from an audio device
+  def __init__(self, device=None, rate=48000, blocksize=256, **pll_options):
+    super().__init__(**pll_options)
+    self.name = 'audio clock'
+    self.rate = rate
+    self.samples = 0
+    self.stream = sd.InputStream(device=device, samplerate=rate, blocksize=blocksize,
+                                 channels=1, callback=self.callback)
+    self.stream.start()
+
+  def callback(self, indata, frames, time_info, status):
+    self.samples += frames
+    self.pll.update(time.perf_counter_ns(), self.samples * 10**9 // self.rate)
+
+  def close(self):
+    self.stream.close()
+
+
+class MtcChaseClock(PllClock):
+  # follows MTC coming in on a MIDI port
+  chase = True
+
+  def __init__(self, port_name, backend=None, **pll_options):
+    super().__init__(**pll_options)
+    self.name = f'chasing mtc on {port_name}'
+    self.decoder = QuarterFrameDecoder()
+    self.port = transport.open_input(port_name, self.on_message, backend)
+
+  def on_message(self, data, timestamp):
+    if data[0] == 0xf1:
+      frames = self.decoder.update(data[1])
+      # only forward, the pll can't follow time running backward
+      if frames is not None and self.decoder.direction > 0:
+        fps = self.decoder.framerate
+        self.pll.update(timestamp, round((frames - 1 + self.decoder.OFFSET) * frame_ns(fps)))
+    elif data[0] == 0xf0 and len(data) == 10 and data[1:5] == b'\x7f\x7f\x01\x01':
+      # the quarter frames that come next are for wherever this says
+      self.decoder.reset()
+      frame_number, rateflag = mtc_frame_number(data[5:9])
+      self.pll.update(timestamp, round(frame_number * frame_ns(MTC_RATES[rateflag])))
+
+  def close(self):
+    self.port.close()
+
+
+class LtcChaseClock(PllClock):
+  # follows LTC coming in on an audio device
+  # the input is decoded a window at a time with the ltc_decode functions
+  chase = True
+
+  def __init__(self, fps, device=None, channel=1, rate=48000, blocksize=256, **pll_options):
+    super().__init__(**pll_options)
+    self.name = 'chasing ltc'
+    self.fps = fps
+    self.frame_ns = frame_ns(fps)
+    self.rate = rate
+    self.channel = channel
+    # long enough to always hold a whole frame, even when running slow
+    self.window = numpy.zeros(rate // 4, dtype=numpy.float32)
+    self.samples = 0
+    self.decoded_at = 0
+    self.stream = sd.InputStream(device=device, samplerate=rate, blocksize=blocksize,
+                                 channels=channel, callback=self.callback)
+    self.stream.start()
+
+  def callback(self, indata, frames, time_info, status):
+    now = time.perf_counter_ns()
+    self.window = numpy.roll(self.window, -frames)
+    self.window[-frames:] = indata[:, self.channel - 1]
+    self.samples += frames
+    # a few times a frame is plenty
+    if self.samples - self.decoded_at < self.rate // 100:
+      return
+    self.decoded_at = self.samples
+    threshold = (float(self.window.max()) + float(self.window.min())) / 2
+    transitions, _ = crossings(0, self.window, threshold, None)
+    offsets, hrs, mins, secs, frs, is_reverse = bits_to_frames(*transitions_to_bits(transitions))
+    if len(offsets) == 0 or is_reverse[-1]:
+      return
+    # when the newest frame started, counted back from the end of the window
+    started = now - (len(self.window) - int(offsets[-1])) * 10**9 // self.rate
+    frame_number = Timecode(self.fps, f'{hrs[-1]:02d}:{mins[-1]:02d}:{secs[-1]:02d}:{frs[-1]:02d}').frame_number
+    self.pll.update(started, round(frame_number * self.frame_ns))
+
+  def close(self):
+    self.stream.close()
+
+
+def open_clock(kind, fps=None, port=None, device=None, channel=1, backend=None):
+  if kind in ('audio', 'ltc') and sd is None:
+    raise RuntimeError('sounddevice is not installed, it is needed for the audio and ltc clocks')
+  if kind == 'audio':
+    return AudioClock(device)
+  if kind == 'mtc':
+    return MtcChaseClock(port, backend)
+  if kind == 'ltc':
+    return LtcChaseClock(fps, device, channel)
+  return MonotonicClock()
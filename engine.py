@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# an asyncio engine for the realtime tools
+#
+# the MIDI ports become async streams: the backend calls back from its own
+# thread and each message is handed over to the event loop with
+# call_soon_threadsafe, so nothing here ever blocks the loop
+# mtc generation, chasing, event playback and recording are coroutines, so
+# one process can run as many of them as it likes side by side, and a
+# show control service can run them on its own loop
+#
+# asyncio wakes up to about a millisecond late, spin_us spends that long at
+# the end of each wait spinning to get closer, which holds up everything
+# else on the loop while it spins, so it is off unless asked for
+
+import asyncio
+import time
+
+import click
+import mido
+from timecode import Timecode
+
+import transport
+from clock import MonotonicClock
+from generate_mtc import MtcCycle, send_full_frame
+from mtc_to_midi import JUMP_FRAMES, MtcPosition, load_events
+
+
+class AsyncInput:
+  # an input port read with `await port.receive()` or `async for data, timestamp in port`
+  # must be opened from inside the running loop
+  def __init__(self, name, backend=None):
+    self.name = name
+    self.loop = asyncio.get_running_loop()
+    self.queue = asyncio.Queue()
+    self.port = transport.open_input(name, self.on_message, backend)
+
+  def on_message(self, data, timestamp):
+    # called from the backend's thread (or the loop's own, for loopback ports)
+    self.loop.call_soon_threadsafe(self.queue.put_nowait, (data, timestamp))
+
+  async def receive(self):
+    return await self.queue.get()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    return await self.queue.get()
+
+  def close(self):
+    self.port.close()
+
+
+class AsyncMtcPosition(MtcPosition):
+  # an MtcPosition that coroutines can wait on for the next timecode
+  def __init__(self):
+    super().__init__()
+    self.changed = asyncio.Condition()
+
+  async def wait(self, timeout=None):
+    # returns when a timecode arrives, or after timeout seconds
+    async with self.changed:
+      try:
+        await asyncio.wait_for(self.changed.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+
+async def sleep_until(deadline, clock=time.perf_counter_ns, spin_ns=0, until=None):
+  # until is a perf_counter_ns time to give up at, returning False, however
+  # far clock moves the deadline while we wait
+  while True:
+    remaining = deadline - clock()
+    if remaining <= spin_ns:
+      break
+    if until is not None:
+      left = until - time.perf_counter_ns()
+      if left <= 0:
+        return False
+      remaining = min(remaining, left + spin_ns)
+    await asyncio.sleep((remaining - spin_ns) / 1e9)
+  while clock() < deadline:
+    if until is not None and time.perf_counter_ns() >= until:
+      return False
+  return True
+
+
+async def generate(output, fps, start_string='00:00:00:00', duration=0, clock=None, spin_us=0):
+  # sends mtc to output, the same as generate_mtc.start_mtc but without the metronome
+  clock = clock or MonotonicClock()
+  spin_ns = spin_us * 1000
+  await asyncio.to_thread(clock.wait_for_lock)
+  cycle = MtcCycle(fps, start_string, clock)
+  start = clock.now()
+  cycle.stop_after(duration, start)
+
+  cycle.locate(start)
+  count = 0
+  while True:
+    if cycle.stopped():
+      return
+    jump = cycle.jump()
+    if jump is not None:
+      if clock.chase:
+        cycle.locate(clock.now())
+        count = 0
+      else:
+        cycle.origin += jump
+    if not await sleep_until(cycle.due(count), clock.now, spin_ns, time.perf_counter_ns() + cycle.quarter_ns):
+      continue
+    if count == 0:
+      send_full_frame(output, cycle.table, cycle.tc.frames)
+    if count % 8 == 0:
+      pieces = cycle.pieces(count)
+    output.send(pieces[count % 8])
+    count += 1
+
+
+async def chase(port, position):
+  # keeps position up to date with the mtc coming in on port
+  async for data, timestamp in port:
+    if position.update(data, timestamp):
+      async with position.changed:
+        position.changed.notify_all()
+
+
+async def playback(position, output, events, spin_us=0):
+  # sends each of events (an mtc_to_midi.EventIndex) when position reaches it
+  # position has to be kept up to date by chase
+  spin_ns = spin_us * 1000
+  cursor = None
+  last = (None, None, 0)
+  while True:
+    # wait for the next event to be nearly due, or for the next timecode
+    timeout = None
+    if cursor is not None and cursor < len(events):
+      due = position.due_at(events.frames[cursor])
+      if due is not None:
+        timeout = max(0, due - time.perf_counter_ns() - spin_ns) / 1e9
+    await position.wait(timeout)
+
+    decoded = (position.frames, position.framerate, position.pll.resyncs)
+    if decoded != last:
+      # going back in time, a new rate, or a jump forward (which the pll may
+      # have taken all at once) starts again from where we are
+      if decoded[1] != last[1] or not last[0] <= decoded[0] <= last[0] + JUMP_FRAMES or decoded[2] != last[2]:
+        cursor = None
+      if cursor is None:
+        cursor = events.locate(position.current_frames(time.perf_counter_ns()), position.framerate)
+      last = decoded
+
+    while cursor is not None and cursor < len(events):
+      due = position.due_at(events.frames[cursor])
+      if due is None or due - time.perf_counter_ns() > spin_ns:
+        break
+      await sleep_until(due, spin_ns=spin_ns)
+      output.send(events.message(cursor))
+      cursor += 1
+
+
+async def record(position, port, config=None, lines=None):
+  # records everything but timecode coming in on port as mtc_to_midi config
+  # lines, saving them to config every so often and when cancelled
+  lines = [] if lines is None else lines
+  try:
+    async for data, timestamp in port:
+      if data[0] == 0xf0 or data[0] == 0xf1:
+        continue
+      tc = Timecode(position.framerate, frames=position.current_frames(timestamp))
+      line = f'{tc} {data.hex(",").upper()} # -> {mido.Message.from_bytes(data)}'
+      lines.append(line)
+      print(line)
+      if config is not None and (len(lines) % 10) == 9:
+        save(config, lines)
+  finally:
+    if config is not None and lines:
+      save(config, lines)
+  return lines
+
+
+def save(config_file, lines):
+  with open(config_file, 'w') as f:
+    f.write('\n'.join(lines))
+
+
+async def run(generate_ports, fps, start, duration, play, record_to, backend, spin):
+  # one chase per mtc port, shared by everything that follows that port
+  inputs = []
+  outputs = []
+  positions = {}
+  tasks = []
+
+  def open_output(name):
+    output = transport.open_output(name, backend)
+    outputs.append(output)
+    return output
+
+  def follow(mtc_port):
+    if mtc_port not in positions:
+      port = AsyncInput(mtc_port, backend)
+      inputs.append(port)
+      positions[mtc_port] = AsyncMtcPosition()
+      tasks.append(chase(port, positions[mtc_port]))
+    return positions[mtc_port]
+
+  for mtc_port, midi_port, config in play:
+    events = load_events(config)
+    print(f'playing {len(events)} events from {config}: MTC on [{mtc_port}] -> MIDI on [{midi_port}]')
+    tasks.append(playback(follow(mtc_port), open_output(midi_port), events, spin))
+  for mtc_port, midi_port, config in record_to:
+    print(f'recording MIDI on [{midi_port}] against MTC on [{mtc_port}] to {config}')
+    position = follow(mtc_port)
+    port = AsyncInput(midi_port, backend)
+    inputs.append(port)
+    tasks.append(record(position, port, config))
+  # the generators go last, so everything listening is ready for the first frame
+  for port in generate_ports:
+    print(f'sending {fps}fps MTC from {start} on [{port}]')
+    tasks.append(generate(open_output(port), fps, start, duration, spin_us=spin))
+
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    for port in inputs + outputs:
+      port.close()
+
+
+@click.command()
+@click.option('--generate', '-g', 'generate_ports', multiple=True, help='send MTC to this MIDI port, can be given more than once')
+@click.option('--fps', '-f', default='24', help='(generate) frames per second, defaults to 24')
+@click.option('--start', '-s', default='00:00:00:00', help='(generate) start timecode, defaults to 00:00:00:00')
+@click.option('--duration', '-d', default=0.0, help='(generate) seconds to run, defaults to 0 (infinite)')
+@click.option('--play', nargs=3, multiple=True, metavar='MTC MIDI CONFIG', help='play the events in CONFIG to port MIDI, following MTC on port MTC')
+@click.option('--record', 'record_to', nargs=3, multiple=True, metavar='MTC MIDI CONFIG', help='record events from port MIDI to CONFIG, following MTC on port MTC')
+@click.option('--backend', type=click.Choice(['rtmidi', 'mido', 'loopback']), help='MIDI backend, defaults to rtmidi when it is installed')
+@click.option('--spin', default=0, help='microseconds to spin at the end of each wait, defaults to 0')
+def main(generate_ports, fps, start, duration, play, record_to, backend, spin):
+  """Runs any number of MTC generators, event players and recorders in one process."""
+  if not (generate_ports or play or record_to):
+    print('Nothing to do. (use --help for more info)')
+    print('Possible ports are:')
+    print(transport.get_output_names(backend))
+    exit()
+  try:
+    asyncio.run(run(generate_ports, fps, start, duration, play, record_to, backend, spin))
+  except KeyboardInterrupt:
+    print()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
-from tools import cint, ltc_encode
+from tools import cint, exact_frame_rate, ltc_encode, ltc_encode_range
 from timecode import Timecode
+from collections import OrderedDict
 import click
+import concurrent.futures
+import csv
+import json
+import numpy
+import os
+import shutil
+import struct
+import time
+
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
 
 
 class MyByteArray:
@@ -14,57 +27,445 @@ class MyByteArray:
     self.buffer[self.cursor] = byte
     self.cursor += 1
 
+  def add_run(self, pattern, count):
+    # repeat a whole run of sample bytes with one slice assignment
+    end = self.cursor + len(pattern) * count
+    self.buffer[self.cursor:end] = pattern * count
+    self.cursor = end
+
 
 def write_wave_file(file_name, data, rate=48000, bits=8):
   header = gen_wave_header(data, rate=rate, bits=bits)
   with open(file_name, 'wb') as f:
     f.write(header)
-    f.write(data)
+    if isinstance(data, numpy.ndarray):
+      # numpy arrays can write their raw buffer in one call
+      data.tofile(f)
+    else:
+      f.write(data)
 
 
-def gen_wave_header(data, rate=48000, bits=8, channels=1):
+def gen_wave_header(data, rate=48000, bits=8, channels=1, data_length=None):
   # integers are stored in C format
   # where 0x0000 + 1 = 0x0100 AND 0xFF00 + 1 = 0x0001
   # the following header has a specified length
   header_length = 4+4+4+4+4+2+2+4+4+2+2+4+4
-  data_length = len(data)
+  if data_length is None:
+    # numpy arrays report their length in samples, not bytes
+    data_length = data.nbytes if isinstance(data, numpy.ndarray) else len(data)
   file_length = header_length + data_length
+  if file_length > 0xFFFFFFFF:
+    # too big for the 32 bit size fields of a plain RIFF file
+    return gen_rf64_header(data_length, rate=rate, bits=bits, channels=channels)
   header = b''
   header += b'RIFF'                              # ascii RIFF
   header += cint(file_length, 4)                  # file size data
   header += b'WAVE'                              # ascii WAVE
-  header += b'fmt '                              # includes trailing space
-  header += cint(16, 4)                           # length of format data (16)
-  header += cint(1, 2)                            # type of format (1 is PCM)
-  header += cint(channels, 2)                     # number of channels
-  header += cint(rate, 4)                         # 44100 sample rate
-  header += cint(rate * bits * channels / 8, 4)  # (sample rate * bits per sample * channels) / 8
-  header += cint(bits * channels / 8, 2)         # (bits per sample * channels) / 8
-  header += cint(bits, 2)                         # bits per sample
+  header += gen_fmt_chunk(rate, bits, channels)
   header += b'data'                              # marks the beginning of the data section
   header += cint(data_length, 4)                  # size of the data section
   return header
 
 
-@click.command()
-@click.option('--fps', '-f',   default='24', help='frames per second, defaults to 24')
-@click.option('--start', '-s', default='00:01:00:00',  help='start timecode, defaults to 00:01:00:00')
-@click.option('--duration', '-d',   default=300.0, help='duration in seconds for the ltc, defaults to 300 (5 minutes)')
-@click.option('--rate', '-r',   default=48000, help='sample rate, defaults to 48000')
-@click.option('--bits', '-b',   default=16, help='bits per sample, defaults to 16')
-def make_ltc_wave(fps, start, duration, rate, bits):
-  fps = float(fps)
-  duration = float(duration)
-  fmt = 'pcm_u8'
+def gen_rf64_header(data_length, rate=48000, bits=8, channels=1):
+  # RF64 (EBU Tech 3306) keeps the RIFF layout but moves the sizes
+  # into a 'ds64' chunk with 64 bit fields
+  header_length = 4+4+4+4+4+8+8+8+4+4+4+2+2+4+4+2+2+4+4
+  file_length = header_length + data_length
+  header = b''
+  header += b'RF64'                              # ascii RF64
+  header += cint(0xFFFFFFFF, 4)                   # size is in the ds64 chunk
+  header += b'WAVE'                              # ascii WAVE
+  header += b'ds64'                              # 64 bit sizes
+  header += cint(28, 4)                           # length of ds64 data (28)
+  header += cint(file_length - 8, 8)              # RIFF size
+  header += cint(data_length, 8)                  # size of the data section
+  header += cint(data_length // (bits * channels // 8), 8)  # number of samples
+  header += cint(0, 4)                            # no extra chunk sizes
+  header += gen_fmt_chunk(rate, bits, channels)
+  header += b'data'                              # marks the beginning of the data section
+  header += cint(0xFFFFFFFF, 4)                   # size is in the ds64 chunk
+  return header
+
+
+def format_tag(bits):
+  # 32 and 64 bit samples are written as floats, see sample_format
+  return WAVE_FORMAT_IEEE_FLOAT if bits in (32, 64) else WAVE_FORMAT_PCM
+
+
+def gen_fmt_chunk(rate, bits, channels):
+  chunk = b''
+  chunk += b'fmt '                               # includes trailing space
+  chunk += cint(16, 4)                            # length of format data (16)
+  chunk += cint(format_tag(bits), 2)              # type of format (1 is PCM, 3 is IEEE float)
+  chunk += cint(channels, 2)                      # number of channels
+  chunk += cint(rate, 4)                          # 44100 sample rate
+  chunk += cint(rate * bits * channels / 8, 4)   # (sample rate * bits per sample * channels) / 8
+  chunk += cint(bits * channels / 8, 2)          # (bits per sample * channels) / 8
+  chunk += cint(bits, 2)                          # bits per sample
+  return chunk
+
+
+def sample_to_bytes(sample, bits):
+  # RIFF wav files use little endian
+  if isinstance(sample, float):
+    return struct.pack('<f' if bits == 32 else '<d', sample)
+  return sample.to_bytes(bits // 8, 'little', signed=bits > 8)
+
+
+def double_pulse_python(tc_encoded):
+  double_pulse_data = ''
+  next_is_up = True
+  for byte_char in tc_encoded:
+    if byte_char == '0':
+      if next_is_up:
+        double_pulse_data += '11'
+      else:
+        double_pulse_data += '00'
+      next_is_up = not next_is_up
+    else:
+      double_pulse_data += '10' if next_is_up else '01'
+  return double_pulse_data
+
+
+def render_pcm_python(double_pulse_data, total_samples, on_val, off_val, bits, timing):
+  bytes_per_sample = bits // 8
+  on_bytes = sample_to_bytes(on_val, bits)
+  off_bytes = sample_to_bytes(off_val, bits)
+
+  # by setting a buffer with a fixed size
+  # and indexing into it, we get a tiny performance boost
+  data = MyByteArray(total_samples * bytes_per_sample)
+  run_start = 0
+  for half_bit, this_val in enumerate(double_pulse_data):
+    if half_bit % 1600 == 0:
+      print(f'   COMPUTING:  {total_samples}:{run_start}  --  {run_start * 100 // total_samples}%', end='\r')
+
+    # every sample up to the start of the next half-bit gets this level
+    run_end = min(sample_of_half_bit(half_bit + 1, timing), total_samples)
+    if this_val == '1':
+      data.add_run(on_bytes, run_end - run_start)
+    else:
+      data.add_run(off_bytes, run_end - run_start)
+    run_start = run_end
+  return data.buffer
+
+
+def double_pulse_numpy(bits, next_is_up=1):
+  # the level flips at the start of every bit, so the first half of a bit
+  # matches next_is_up when an even number of zeroes came before it
+  zeroes = bits ^ 1
+  zeroes_before = numpy.bitwise_xor.accumulate(zeroes) ^ zeroes
+  first_half = zeroes_before ^ next_is_up
+
+  # a one also flips halfway through the bit
+  double_pulse_data = numpy.empty(len(bits) * 2, dtype=numpy.uint8)
+  double_pulse_data[0::2] = first_half
+  double_pulse_data[1::2] = first_half ^ bits
+  return double_pulse_data
+
+
+def sample_levels(on_val, off_val, bits):
+  # each row holds the little endian bytes of one sample value
+  # so mapping pulses to rows gives us the finished pcm data
+  levels = numpy.frombuffer(sample_to_bytes(off_val, bits) + sample_to_bytes(on_val, bits), dtype=numpy.uint8)
+  return levels.reshape(2, bits // 8)
+
+
+def half_bits_per_sample(fps, rate):
+  # all sample timing is done with this exact fraction
+  # so the ltc stays locked to the sample clock for any duration
+  # sample s falls in half-bit (s * timing.numerator) // timing.denominator
+  return exact_frame_rate(fps) * 160 / rate
+
+
+def sample_of_half_bit(half_bit, timing):
+  # the first sample at or after the start of this half-bit
+  return -(-half_bit * timing.denominator // timing.numerator)
+
+
+def frames_for_samples(total_samples, timing):
+  # how many frames it takes to cover every sample
+  if total_samples == 0:
+    return 0
+  return (total_samples - 1) * timing.numerator // timing.denominator // 160 + 1
+
+
+def pulse_positions(timing, start, end):
+  # the half-bit of every sample from start to end
+  return numpy.arange(start, end, dtype=numpy.int64) * timing.numerator // timing.denominator
+
+
+def render_pcm_numpy(double_pulse_data, total_samples, on_val, off_val, bits, timing):
+  levels = sample_levels(on_val, off_val, bits)
+
+  # every half-bit fills the samples up to the start of the next one
+  print(f'   COMPUTING:  {total_samples} samples', end='\r')
+  half_bit_ends = numpy.arange(1, len(double_pulse_data) + 1, dtype=numpy.int64)
+  half_bit_ends = numpy.minimum(-(-half_bit_ends * timing.denominator // timing.numerator), total_samples)
+  run_lengths = numpy.diff(half_bit_ends, prepend=0)
+  return numpy.take(levels, numpy.repeat(double_pulse_data, run_lengths), axis=0)
+
+
+def pcm_chunks(tc, timing, total_samples, levels, start=0, end=None,
+               first_frame=0, next_is_up=1, chunk_size=1 << 20, frames=None):
+  # yields the pcm data for samples start to end one chunk at a time
+  # frames are encoded just before the chunk of samples that needs them,
+  # so memory use depends on chunk_size and not on the duration
+  # first_frame is where encoding begins and next_is_up is its starting level
+  # frames can hold every frame already encoded with numpy.packbits
+  if end is None:
+    end = total_samples
+  double_pulse_data = numpy.empty(0, dtype=numpy.uint8)
+  encoded_frames = first_frame
+
+  for chunk_start in range(start, end, chunk_size):
+    chunk_end = min(chunk_start + chunk_size, end)
+    positions = pulse_positions(timing, chunk_start, chunk_end)
+
+    # encode every frame up to the end of this chunk
+    # carrying the pulse level over from the previous chunk
+    last_frame = int(positions[-1]) // 160
+    if last_frame >= encoded_frames:
+      if frames is None:
+        bits_data = ltc_encode_range(tc, last_frame + 1 - encoded_frames, offset=encoded_frames).ravel()
+      else:
+        bits_data = numpy.unpackbits(frames[encoded_frames:last_frame + 1]).ravel()
+      new_pulses = double_pulse_numpy(bits_data, next_is_up)
+      next_is_up = new_pulses[-1] ^ 1
+      double_pulse_data = numpy.concatenate((double_pulse_data, new_pulses))
+      encoded_frames = last_frame + 1
+
+    # forget the frames this chunk no longer needs
+    chunk_first_frame = int(positions[0]) // 160
+    if chunk_first_frame > first_frame:
+      double_pulse_data = double_pulse_data[(chunk_first_frame - first_frame) * 160:]
+      first_frame = chunk_first_frame
+
+    yield chunk_start, numpy.take(levels, numpy.take(double_pulse_data, positions - first_frame * 160), axis=0)
+
+
+def rise_time_kernel(rise_time, rate, max_taps):
+  # a hann window, whose step response rises from 10% to 90%
+  # in 0.482 of the window length
+  taps = max(1, min(round(rise_time * rate / 0.482), max_taps))
+  taps += 1 - taps % 2    # odd, so the kernel is centred on a sample
+  kernel = numpy.hanning(taps + 2)[1:-1]
+  return kernel / kernel.sum()
+
+
+def sample_values_to_pcm(values, on_val, off_val, bits):
+  # values run from 0 (off) to 1 (on)
+  samples = off_val + values * (on_val - off_val)
+  if bits == 32:
+    return samples.astype('<f4').view(numpy.uint8).reshape(-1, 4)
+  if bits == 64:
+    return samples.astype('<f8').view(numpy.uint8).reshape(-1, 8)
+  # integer samples keep the low bytes of a little endian int32
+  samples = numpy.rint(samples).astype('<i4').view(numpy.uint8).reshape(-1, 4)
+  return numpy.ascontiguousarray(samples[:, :bits // 8])
+
+
+def shaped_levels(kernel, on_val, off_val, bits):
+  # rows 0 and 1 are the steady off and on levels, followed by the
+  # len(kernel) - 1 samples around a rising edge and then a falling edge
+  step = numpy.cumsum(kernel)[:-1]
+  return sample_values_to_pcm(numpy.concatenate(([0.0, 1.0], step, 1 - step)), on_val, off_val, bits)
+
+
+def shaped_pcm_chunks(tc, timing, total_samples, kernel, levels, chunk_frames=256):
+  # yields the square wave convolved with the kernel one chunk of frames at a time
+  # the kernel is never longer than a half-bit, so a sample is only ever near one
+  # edge and every half-bit run of samples is a head, a steady body and a tail
+  # whose rows in levels only depend on the levels before, during and after it
+  half = len(kernel) // 2
+  rising = 2
+  falling = 2 + len(kernel) - 1
+  steps = numpy.arange(half)
+  frame_count = frames_for_samples(total_samples, timing)
+  prev_level = None
+
+  for first_frame in range(0, frame_count, chunk_frames):
+    count = min(chunk_frames, frame_count - first_frame)
+    bits_data = ltc_encode_range(tc, count, offset=first_frame).ravel()
+    if prev_level is None:
+      cur = double_pulse_numpy(bits_data).astype(numpy.int64)
+      prev_level = cur[0]    # nothing comes before the first edge
+    else:
+      cur = double_pulse_numpy(bits_data, prev_level ^ 1).astype(numpy.int64)
+
+    half_bits = numpy.arange(first_frame * 160, (first_frame + count) * 160 + 1, dtype=numpy.int64)
+    run_edges = numpy.minimum(-(-half_bits * timing.denominator // timing.numerator), total_samples)
+    run_lengths = numpy.diff(run_edges)
+    prev = numpy.concatenate(([prev_level], cur[:-1]))
+    # the level always flips between bits, and nothing comes after the end
+    nxt = numpy.concatenate((cur[1:], [cur[-1] ^ 1]))
+    nxt = numpy.where(run_edges[1:] >= total_samples, cur, nxt)
+    prev_level = int(cur[-1])
+
+    head = numpy.where((prev != cur)[:, None], numpy.where(cur == 1, rising, falling)[:, None] + half + steps, cur[:, None])
+    tail = numpy.where((nxt != cur)[:, None], numpy.where(nxt == 1, rising, falling)[:, None] + steps, cur[:, None])
+    rows = numpy.concatenate((head, cur[:, None], tail), axis=1)
+    # runs cut short by the end of the file lose their body first, then their tail
+    run_lengths = run_lengths[:, None]
+    counts = numpy.concatenate((
+        steps < run_lengths,
+        numpy.maximum(run_lengths - 2 * half, 0),
+        steps >= 2 * half - run_lengths), axis=1)
+    chunk = numpy.take(levels, numpy.repeat(rows.ravel(), counts.ravel()), axis=0)
+    yield int(run_edges[0]), chunk
 
+
+def write_wave_stream(file_name, chunks, total_samples, bits, rate=48000, progress=True):
+  # chunks yields (first sample, pcm data) in order
+  data_length = total_samples * (bits // 8)
+  bytes_written = 0
+  with open(file_name, 'wb') as f:
+    f.write(gen_wave_header(None, rate=rate, bits=bits, data_length=data_length))
+    for chunk_start, chunk in chunks:
+      if progress:
+        print(f'   COMPUTING:  {total_samples}:{chunk_start}  --  {chunk_start * 100 // total_samples}%', end='\r')
+      chunk.tofile(f)
+      bytes_written += chunk.nbytes
+
+    # patch the sizes with what actually made it into the file
+    f.seek(0)
+    f.write(gen_wave_header(None, rate=rate, bits=bits, data_length=bytes_written))
+
+
+class WaveformCache:
+  # rendered samples for 16 bit pieces of a frame
+  # a piece always renders the same way given its bits, its starting
+  # level and where its first half-bit falls between two samples
+  def __init__(self, levels, timing, maxsize=1 << 14):
+    self.levels = levels
+    self.timing = timing
+    self.maxsize = maxsize
+    self.blocks = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def block(self, piece, next_is_up, phase):
+    # phase is how far the first sample is past the start of the first half-bit
+    # in units of 1 / (timing.numerator * timing.denominator) samples
+    key = (piece, next_is_up, phase)
+    entry = self.blocks.get(key)
+    if entry is not None:
+      self.hits += 1
+      self.blocks.move_to_end(key)
+      return entry
+
+    self.misses += 1
+    entry = self.render(piece, next_is_up, phase)
+    self.blocks[key] = entry
+    if len(self.blocks) > self.maxsize:
+      self.blocks.popitem(last=False)
+    return entry
+
+  def render(self, piece, next_is_up, phase):
+    bits = numpy.unpackbits(numpy.frombuffer(piece, dtype=numpy.uint8))
+    double_pulse_data = double_pulse_numpy(bits, next_is_up)
+    num, den = self.timing.numerator, self.timing.denominator
+    sample_count = -(-(len(double_pulse_data) * den - phase) // num)
+    positions = (numpy.arange(sample_count, dtype=numpy.int64) * num + phase) // den
+    samples = numpy.take(self.levels, numpy.take(double_pulse_data, positions), axis=0)
+    return samples, int(double_pulse_data[-1] ^ 1)
+
+
+def cached_pcm_chunks(tc, total_samples, cache, chunk_frames=256):
+  # yields the pcm data one chunk of frames at a time
+  timing = cache.timing
+  frame_count = frames_for_samples(total_samples, timing)
+  next_is_up = 1
+
+  for first_frame in range(0, frame_count, chunk_frames):
+    count = min(chunk_frames, frame_count - first_frame)
+    pieces = numpy.packbits(ltc_encode_range(tc, count, offset=first_frame), axis=1)
+    chunk_start = sample_of_half_bit(first_frame * 160, timing)
+    chunk_end = min(total_samples, sample_of_half_bit((first_frame + count) * 160, timing))
+    chunk = numpy.empty((chunk_end - chunk_start, cache.levels.shape[1]), dtype=numpy.uint8)
+
+    for i in range(count):
+      for j in range(5):
+        half_bit = (first_frame + i) * 160 + j * 32
+        piece_start = sample_of_half_bit(half_bit, timing)
+        phase = piece_start * timing.numerator - half_bit * timing.denominator
+        samples, next_is_up = cache.block(pieces[i, j * 2:j * 2 + 2].tobytes(), next_is_up, phase)
+        offset = piece_start - chunk_start
+        length = max(0, min(len(samples), chunk_end - piece_start))
+        chunk[offset:offset + length] = samples[:length]
+    yield chunk_start, chunk
+
+
+def frame_levels(tc, frames, block_size=1 << 16):
+  # the starting pulse level of each of the (sorted) frames
+  # every zero bit flips the level, so it only depends on how many zeroes came before
+  levels = []
+  next_is_up = 1
+  encoded_frames = 0
+  for frame in frames:
+    while encoded_frames < frame:
+      count = min(block_size, frame - encoded_frames)
+      zeroes = 80 - int(ltc_encode_range(tc, count, offset=encoded_frames).sum())
+      next_is_up ^= zeroes & 1
+      encoded_frames += count
+    levels.append(next_is_up)
+  return levels
+
+
+def render_segment(file_name, offset, tc, timing, total_samples, levels, start, end, first_frame, next_is_up):
+  # runs in a worker process and writes its samples straight into their place in the file
+  fd = os.open(file_name, os.O_WRONLY)
+  try:
+    for chunk_start, chunk in pcm_chunks(tc, timing, total_samples, levels, start, end, first_frame, next_is_up):
+      os.pwrite(fd, chunk, offset + chunk_start * levels.shape[1])
+  finally:
+    os.close(fd)
+  return end - start
+
+
+def write_wave_parallel(file_name, tc, timing, total_samples, on_val, off_val, bits, rate=48000, workers=1):
+  levels = sample_levels(on_val, off_val, bits)
+  header = gen_wave_header(None, rate=rate, bits=bits, data_length=total_samples * (bits // 8))
+  with open(file_name, 'wb') as f:
+    f.write(header)
+    f.truncate(len(header) + total_samples * (bits // 8))
+
+  # split the frames evenly and start each segment on the first sample of a frame
+  frame_count = frames_for_samples(total_samples, timing)
+  segment_frames = [frame_count * i // workers for i in range(workers)]
+  segment_starts = [sample_of_half_bit(frame * 160, timing) for frame in segment_frames]
+  segment_starts.append(total_samples)
+  segment_levels = frame_levels(tc, segment_frames)
+
+  samples_done = 0
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = []
+    for i in range(workers):
+      start, end = segment_starts[i], segment_starts[i + 1]
+      if start < end:
+        futures.append(pool.submit(render_segment, file_name, len(header), tc, timing, total_samples,
+                                   levels, start, end, segment_frames[i], segment_levels[i]))
+    for future in concurrent.futures.as_completed(futures):
+      samples_done += future.result()
+      print(f'   COMPUTING:  {total_samples}:{samples_done}  --  {samples_done * 100 // total_samples}%', end='\r')
+
+
+def sample_format(bits):
   # if bits is 8, samples are unsigned values from 0 - 255
   # if bits is 16, samples should be signed from -32768 to 32767
+  # if bits is 24, samples should be signed from -8388608 to 8388607
+  fmt = 'pcm_u8'
   on_val = 255
   off_val = 0
   if bits == 16:
     fmt = 'pcm_s16le'
     on_val = 32767
     off_val = -32768
+  elif bits == 24:
+    fmt = 'pcm_s24le'
+    on_val = 8388607
+    off_val = -8388608
   elif bits == 32 or bits == 64:
     if bits == 32:
       fmt = 'pcm_f32le'
@@ -72,10 +473,147 @@ def make_ltc_wave(fps, start, duration, rate, bits):
       fmt = 'pcm_f64le'
     on_val = 1.0
     off_val = 0.0
+  return fmt, on_val, off_val
+
+
+def ltc_file_name(start, fps, rate, bits, duration):
+  fmt = sample_format(bits)[0]
+  return 'ltc--{}--{}fps--{}--{}--{}secs.wav'.format(
+      start.replace(':', '_'), fps, rate, fmt, duration)
+
+
+def read_manifest(file_name, defaults):
+  # a manifest is either a csv file with a header row or a json list of objects
+  # using the keys start, fps, duration, rate, bits and filename
+  # anything left out comes from defaults
+  if file_name.endswith('.json'):
+    with open(file_name, 'r') as f:
+      rows = json.load(f)
+  else:
+    with open(file_name, 'r', newline='') as f:
+      rows = list(csv.DictReader(f))
+
+  jobs = []
+  for row in rows:
+    # blank csv cells count as missing
+    row = {key: value for key, value in row.items() if value not in (None, '')}
+    job = {
+        'start': str(row.get('start', defaults['start'])),
+        'fps': float(row.get('fps', defaults['fps'])),
+        'duration': float(row.get('duration', defaults['duration'])),
+        'rate': int(row.get('rate', defaults['rate'])),
+        'bits': int(row.get('bits', defaults['bits'])),
+    }
+    job['filename'] = row.get('filename') or ltc_file_name(**job)
+    jobs.append(job)
+  return jobs
+
+
+def encode_shared_frames(jobs, block_size=1 << 16):
+  # jobs with the same frame rate share one encoding of every frame they need
+  # returns the packed frames (10 bytes each) for every job, in order
+  ranges = {}
+  for i, job in enumerate(jobs):
+    tc = Timecode(job['fps'], job['start'])
+    timing = half_bits_per_sample(job['fps'], job['rate'])
+    frame_count = frames_for_samples(int(job['rate'] * job['duration']), timing)
+    key = (tc.framerate, tc.drop_frame)
+    ranges.setdefault(key, []).append((tc.frames, tc.frames + frame_count, i))
+
+  job_frames = [None] * len(jobs)
+  for (framerate, drop_frame), job_ranges in ranges.items():
+    # merge the overlapping ranges and encode each merged range once
+    job_ranges.sort()
+    merged = []
+    for first, last, i in job_ranges:
+      if merged and first <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], last)
+        merged[-1][2].append(i)
+      else:
+        merged.append([first, last, [i]])
+
+    for first, last, members in merged:
+      tc = Timecode(jobs[members[0]]['fps'], frames=first)
+      frames = numpy.empty((last - first, 10), dtype=numpy.uint8)
+      for offset in range(0, last - first, block_size):
+        count = min(block_size, last - first - offset)
+        frames[offset:offset + count] = numpy.packbits(ltc_encode_range(tc, count, offset=offset), axis=1)
+      for i in members:
+        job_first = Timecode(jobs[i]['fps'], jobs[i]['start']).frames - first
+        job_frames[i] = frames[job_first:last - first]
+  return job_frames
+
+
+def render_job(job, frames):
+  # runs in a worker process, returns the samples written and the seconds it took
+  started = time.perf_counter()
+  fmt, on_val, off_val = sample_format(job['bits'])
+  tc = Timecode(job['fps'], job['start'])
+  timing = half_bits_per_sample(job['fps'], job['rate'])
+  total_samples = int(job['rate'] * job['duration'])
+  frames = frames[:frames_for_samples(total_samples, timing)]
+  chunks = pcm_chunks(tc, timing, total_samples, sample_levels(on_val, off_val, job['bits']), frames=frames)
+  write_wave_stream(job['filename'], chunks, total_samples, job['bits'], rate=job['rate'], progress=False)
+  return total_samples, time.perf_counter() - started
+
+
+def render_batch(jobs, workers=1):
+  # identical jobs are only rendered once and then copied
+  renders = {}
+  for job in jobs:
+    key = (job['start'], job['fps'], job['duration'], job['rate'], job['bits'])
+    renders.setdefault(key, []).append(job)
+  unique_jobs = [same_jobs[0] for same_jobs in renders.values()]
+
+  print(f'Encoding frames for {len(unique_jobs)} unique jobs')
+  job_frames = encode_shared_frames(unique_jobs)
+
+  results = {}
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {}
+    for job, frames in zip(unique_jobs, job_frames):
+      futures[pool.submit(render_job, job, frames)] = job
+    for future in concurrent.futures.as_completed(futures):
+      job = futures[future]
+      results[job['filename']] = future.result()
+      print(f'   RENDERED:  {job["filename"]}')
+
+  for same_jobs in renders.values():
+    for job in same_jobs[1:]:
+      shutil.copyfile(same_jobs[0]['filename'], job['filename'])
+      results[job['filename']] = results[same_jobs[0]['filename']]
+
+  print()
+  print(f'{"samples":>12} {"seconds":>9} {"samples/sec":>14}  file')
+  for job in jobs:
+    samples, seconds = results[job['filename']]
+    print(f'{samples:>12} {seconds:>9.3f} {samples / max(seconds, 1e-9):>14.0f}  {job["filename"]}')
+
+
+@click.command()
+@click.option('--fps', '-f',   default='24', help='frames per second, defaults to 24')
+@click.option('--start', '-s', default='00:01:00:00',  help='start timecode, defaults to 00:01:00:00')
+@click.option('--duration', '-d',   default=300.0, help='duration in seconds for the ltc, defaults to 300 (5 minutes)')
+@click.option('--rate', '-r',   default=48000, help='sample rate, defaults to 48000')
+@click.option('--bits', '-b',   default=16, help='bits per sample, defaults to 16')
+@click.option('--engine', '-e', default='python', type=click.Choice(['python', 'numpy', 'stream', 'cache']), help='rendering engine, defaults to python')
+@click.option('--workers', '-w', default=1, help='render segments (or manifest jobs) in this many processes, defaults to 1')
+@click.option('--manifest', '-m', help='csv or json file listing many reels to render, the other options become defaults')
+@click.option('--rise-time', default=0.0, help='shape the edges to this 10-90% rise time in microseconds (SMPTE says 25-50), defaults to 0 (square)')
+def make_ltc_wave(fps, start, duration, rate, bits, engine, workers, manifest, rise_time):
+  if manifest is not None:
+    defaults = {'start': start, 'fps': fps, 'duration': duration, 'rate': rate, 'bits': bits}
+    jobs = read_manifest(manifest, defaults)
+    print(f'BATCH RENDERING {len(jobs)} LTC FILES FROM: {manifest}')
+    render_batch(jobs, workers=workers)
+    print('DONE\n\n')
+    return
+
+  fps = float(fps)
+  duration = float(duration)
+  fmt, on_val, off_val = sample_format(bits)
 
   total_samples = int(rate * duration)
-  bytes_per_sample = bits // 8
-  total_bytes = total_samples * bytes_per_sample
 
   # MIDI timecodes arrive in frames
   # each frame has 80 bytes, and each byte is represented by two "notes"
@@ -85,69 +623,88 @@ def make_ltc_wave(fps, start, duration, rate, bits):
 
   # generate the MIDI timecode data for the entire duration
   tc = Timecode(fps, start)
-  tc_encoded = []
+  timing = half_bits_per_sample(fps, rate)
+  frame_count = frames_for_samples(total_samples, timing)
   print('PREPARING MIDI TIMECODE BYTES:')
-  print(f'| {start}\n| {fps} fps\n| {duration} secs')
+  print(f'| {start}\n| {fps} fps\n| {duration} secs\n| {engine} engine')
+  wave_file_name = ltc_file_name(start, fps, rate, bits, duration)
+
+  if rise_time > 0:
+    # the shaped edges can't be longer than the shortest half-bit
+    print(f'Streaming WAV File with {rise_time} µs edges: {wave_file_name}')
+    kernel = rise_time_kernel(rise_time / 1000000, rate, int(1 / timing))
+    levels = shaped_levels(kernel, on_val, off_val, bits)
+    chunks = shaped_pcm_chunks(tc, timing, total_samples, kernel, levels)
+    write_wave_stream(wave_file_name, chunks, total_samples, bits, rate=rate)
+    print()
+    print('DONE\n\n')
+    return
+
+  if workers > 1:
+    # each worker streams its own segment into a pre-sized file
+    print(f'Rendering WAV File with {workers} workers: {wave_file_name}')
+    write_wave_parallel(wave_file_name, tc, timing, total_samples, on_val, off_val, bits, rate=rate, workers=workers)
+    print()
+    print('DONE\n\n')
+    return
+
+  if engine == 'stream':
+    # frames, pulses and samples are generated one chunk at a time
+    print(f'Streaming WAV File: {wave_file_name}')
+    chunks = pcm_chunks(tc, timing, total_samples, sample_levels(on_val, off_val, bits))
+    write_wave_stream(wave_file_name, chunks, total_samples, bits, rate=rate)
+    print()
+    print('DONE\n\n')
+    return
+
+  if engine == 'cache':
+    # frames are assembled from cached pieces
+    print(f'Streaming WAV File: {wave_file_name}')
+    cache = WaveformCache(sample_levels(on_val, off_val, bits), timing)
+    write_wave_stream(wave_file_name, cached_pcm_chunks(tc, total_samples, cache), total_samples, bits, rate=rate)
+    print()
+    print(f'Waveform cache: {cache.hits} hits, {cache.misses} misses, {len(cache.blocks)} blocks')
+    print('DONE\n\n')
+    return
+
   print('Generating Timecode Stream')
-  for i in range(int(duration * fps) + 1):
-    # this is the first frame
-    e = ltc_encode(tc, as_string=True)
-    tc_encoded.append(e)
-    tc.next()
+  if engine == 'numpy':
+    # one row of 80 bits per frame
+    tc_encoded = ltc_encode_range(tc, frame_count).ravel()
+  else:
+    tc_encoded = []
+    for i in range(frame_count):
+      # this is the first frame
+      e = ltc_encode(tc, as_string=True)
+      tc_encoded.append(e)
+      tc.next()
 
-  # lists are faster than string concatenation even when joining them at the end
-  tc_encoded = ''.join(tc_encoded)
+    # lists are faster than string concatenation even when joining them at the end
+    tc_encoded = ''.join(tc_encoded)
 
   print('Generating "Double Pulse" Data Stream')
-  double_pulse_data = ''
-  next_is_up = True
-  for byte_char in tc_encoded:
-    if byte_char == '0':
-      if next_is_up:
-        double_pulse_data += '11'
-      else:
-        double_pulse_data += '00'
-      next_is_up = not next_is_up
-    else:
-      double_pulse_data += '10' if next_is_up else '01'
+  if engine == 'numpy':
+    double_pulse_data = double_pulse_numpy(tc_encoded)
+  else:
+    double_pulse_data = double_pulse_python(tc_encoded)
 
   # at this point, we have a string of zeroes and ones
   # now, we just need to map them to pulse data over the
   # duration of the data stream
   print('Creating PCM Data Stream')
-
-  # by setting a buffer with a fixed size
-  # and indexing into it, we get a tiny performance boost
-  data = MyByteArray(total_bytes)
-  for sample_num in range(total_samples):
-    ratio = sample_num/total_samples
-    pct = int(ratio * 100)
-    if sample_num % 1000 == 0:
-      print(f'   COMPUTING:  {total_samples}:{sample_num}  --  {pct}%', end='\r')
-
-    double_pulse_position = len(double_pulse_data) * ratio
-    dpp_intpart = int(double_pulse_position)
-    this_val = int(double_pulse_data[dpp_intpart])
-
-    if this_val == 1:
-      sample = on_val
-    else:
-      sample = off_val
-
-    # RIFF wav files use little endian
-    sample_bytes = sample.to_bytes(bytes_per_sample, 'little', signed=bits > 8)
-    for byte in sample_bytes:
-      data.add(byte)
+  if engine == 'numpy':
+    data = render_pcm_numpy(double_pulse_data, total_samples, on_val, off_val, bits, timing)
+  else:
+    data = render_pcm_python(double_pulse_data, total_samples, on_val, off_val, bits, timing)
 
   # everything has been computed
   # prepare to write the wave file
   print()
 
-  wave_file_name = 'ltc--{}--{}fps--{}--{}--{}secs.wav'.format(
-      start.replace(':', '_'), fps, rate, fmt, duration)
   print(f'Writing WAV File: {wave_file_name}')
-  write_wave_file(wave_file_name, data.buffer, rate=rate, bits=bits)
+  write_wave_file(wave_file_name, data, rate=rate, bits=bits)
   print('DONE\n\n')
 
 
-make_ltc_wave()
+if __name__ == '__main__':
+  make_ltc_wave()
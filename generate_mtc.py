@@ -2,119 +2,210 @@
 
 # use click library
 # user input:
-# 	fps, start, duration, midi_port
+# 	fps, start, duration, midi_port(s)
 
-import time
 import click
-import mido
+import time
 from timecode import Timecode
 
 import tools
+import transport
+from clock import MonotonicClock, open_clock
+from scheduler import Scheduler
 
 
 def send_click(outport, note):
-  msg = mido.Message('note_on', note=note, velocity=127, channel=9)
-  outport.send(msg)
-  msg = mido.Message('note_off', note=note, velocity=0, channel=9)
-  outport.send(msg)
-
-
-def send_full_frame(outport, timecode):
-  full_frame = tools.mtc_full_frame(timecode)
-  # print(full_frame)
-  msg = mido.Message.from_bytes(full_frame)
-  outport.send(msg)
-
-
-def send_quarter_frames(outport, timecode, part=0):
-  if part == 8:
-    return
-  # print (timecode)
-  qframe = tools.mtc_quarter_frame(timecode, part)
-  # print(qframe)
-  msg = mido.Message.from_bytes(qframe)
-  outport.send(msg)
-  send_quarter_frames(outport, timecode, part+1)
-
-
-def start_mtc(outport, fps, start_string, duration, click_data=None):
-  tc = Timecode(fps, start_string)
-  frametime = 1/float(fps)
-  start = time.time()
-  end = start + int(duration)
-  if duration == 0:
-    infinite = True
+  # note on and note off on channel 10
+  outport.send([0x99, note, 127])
+  outport.send([0x89, note, 0])
+
+
+def send_full_frame(outport, table, frames):
+  outport.send(table.full_frame(frames))
+
+
+def quarter_frame_messages(table, frames):
+  # all eight pieces for a frame, sliced ahead of time so sending is just a send
+  return [table.quarter_frame(frames, piece) for piece in range(8)]
+
+
+class MtcCycle:
+  # what goes out when, for the mtc senders
+  # a full frame says where we start, then one quarter frame piece goes out every
+  # quarter of a frame, so the eight pieces of each timecode span two frames
+  # quarter frame n is due n * quarter_num / quarter_den ns after the origin, exactly
+  # the message bytes come from a table covering the next minute or so
+  # a chasing clock decides where to start, and moves us when it relocates
+  # the deadlines are on the clock's timeline, so when the clock jumps they
+  # jump with it, and a sender waiting on one would hear nothing about it
+  # until the wait was over; senders look in at least every quarter_ns of
+  # real time instead, and act on a jump straight away
+  # the duration is kept on this computer's clock, a relocating reference
+  # can't move it
+  # any clock following a reference has to have heard from it before now()
+  # means anything, so make a cycle once clock.wait_for_lock() has returned
+  def __init__(self, fps, start_string, clock):
+    self.fps = fps
+    self.clock = clock
+    rate = tools.exact_frame_rate(float(fps))
+    self.quarter_num, self.quarter_den = 10**9 * rate.denominator, 4 * rate.numerator
+    self.quarter_ns = self.quarter_num // self.quarter_den
+    self.table_frames = round(float(fps)) * 60
+    self.tc = Timecode(fps, start_string)
+    self.table = tools.MtcFrameTable(self.tc, self.table_frames)
+    self.origin = 0
+    self.first_quarter = 0
+    self.resyncs = clock.resyncs()
+    self.offset = clock.now() - time.perf_counter_ns()
+    self.stop_at = None
+
+  def stop_after(self, duration, start):
+    # start is when the mtc begins on the clock, 0 runs forever
+    if duration:
+      self.stop_at = time.perf_counter_ns() + start - self.clock.now() + round(duration * 1e9)
+
+  def stopped(self):
+    return self.stop_at is not None and time.perf_counter_ns() >= self.stop_at
+
+  def locate(self, origin):
+    # starts again from count 0, at origin from the start timecode, or when
+    # chasing, from the next frame of the reference
+    self.resyncs = self.clock.resyncs()
+    self.offset = self.clock.now() - time.perf_counter_ns()
+    if self.clock.chase:
+      frame = -(-self.clock.now() * self.quarter_den // (4 * self.quarter_num))
+      self.tc = Timecode(self.fps, frames=frame + 1)
+      self.origin, self.first_quarter = 0, 4 * frame
+    else:
+      self.origin, self.first_quarter = origin, 0
+    if self.tc.frames not in self.table:
+      self.table = tools.MtcFrameTable(self.tc, self.table_frames)
+
+  def due(self, count):
+    return self.origin + -(-(self.first_quarter + count) * self.quarter_num // self.quarter_den)
+
+  def jump(self):
+    # how far (in ns, forward or back) the clock has jumped since it was last
+    # asked, or None when it hasn't
+    # a chasing clock has to be located again after a jump, any other
+    # clock jumping shouldn't move the timecode we send, so everything still
+    # to send moves with it, origin included
+    offset = self.clock.now() - time.perf_counter_ns()
+    jump = None
+    if self.clock.resyncs() != self.resyncs:
+      self.resyncs = self.clock.resyncs()
+      jump = offset - self.offset
+    self.offset = offset
+    return jump
+
+  def pieces(self, count):
+    # the eight pieces of the timecode starting at count, a multiple of 8
+    frames = self.tc.frames + count // 4
+    if frames not in self.table:
+      self.table = tools.MtcFrameTable(Timecode(self.fps, frames=frames), self.table_frames)
+    return quarter_frame_messages(self.table, frames)
+
+
+def start_mtc(outport, fps, start_string, duration, click_data=None, spin_us=200, clock=None):
+  clock = clock or MonotonicClock()
+  scheduler = Scheduler(spin_us, clock.now)
+  infinite = duration == 0
 
   runstring = 'forever' if infinite else f'for {duration}s'
-  print(f'STARTING MTC: {fps}fps {start_string} - will run {runstring}')
-  next_frame_time = start + tc.frame_number * frametime
-  next_full_frame_time = start
-  next_click_time = start
-  do_click = False
-  runuptimes = []
+  if clock.chase:
+    print(f'STARTING MTC: {fps}fps {clock.name} - will run {runstring}')
+  else:
+    print(f'STARTING MTC: {fps}fps {start_string} - will run {runstring}')
+  clock.wait_for_lock()
+
+  # the first table is built before the start is taken, so the first
+  # messages aren't held up by it
+  cycle = MtcCycle(fps, start_string, clock)
+  pieces = next_pieces = None
+  start = scheduler.now()
   if click_data is not None:
-    in_runup = True
-    do_click = True
-    clicktime = 60 / float(click_data['bpm'])
+    click_ns = 60e9 / float(click_data['bpm'])
     click_divs = int(click_data['division'])
     click_bnote = int(click_data['base_note'])
     click_anote = int(click_data['accent_note'])
-    if click_divs == 3:
-      runuptimes = [start, start+clicktime*2, start+clicktime*3, start+clicktime*5]
-      for i in range(6, click_divs + 6):
-        runuptimes.append(start + clicktime*i)
+    # the run up clicks, counted in beats from now
+    # when chasing, the reference decides when we start, so there is no run up
+    if clock.chase:
+      runup_beats = []
+    elif click_divs == 3:
+      runup_beats = [0, 2, 3, 5] + list(range(6, click_divs + 6))
     elif click_divs == 4:
-      runuptimes = [start, start+clicktime*2]
-      for i in range(4, click_divs+4):
-        runuptimes.append(start + clicktime * i)
+      runup_beats = [0, 2] + list(range(4, click_divs + 4))
     elif click_divs == 6:
-      runuptimes = [start, start+clicktime*3]
-      for i in range(6, click_divs+6):
-        runuptimes.append(start + clicktime * i)
+      runup_beats = [0, 3] + list(range(6, click_divs + 6))
     else:
-      runuptimes = []
-      for i in range(click_divs*2):
-        runuptimes.append(start + clicktime * i)
-    runuptime = runuptimes[-1] + clicktime
-    start = runuptime
-    next_click_time = runuptime
-  click_counter = 0
-
-  while len(runuptimes) > 0:
-    now = time.time()
-    if now >= runuptimes[0]:
-      send_click(outport, click_anote + 12)
-      runuptimes = runuptimes[1:]
+      runup_beats = list(range(click_divs * 2))
+    for beat in runup_beats:
+      scheduler.at(start + round(beat * click_ns), 'click', lambda deadline: send_click(outport, click_anote + 12))
+    if runup_beats:
+      start += round((runup_beats[-1] + 1) * click_ns)
+    def do_click(deadline, count):
+      send_click(outport, click_anote if count % click_divs == 0 else click_bnote)
+      # counted from the first click's deadline, wherever a jump of the clock has moved it
+      click_start = deadline - round(count * click_ns)
+      scheduler.at(click_start + round((count + 1) * click_ns), 'click', do_click, count + 1)
+
+    scheduler.at(start, 'click', do_click, 0)
+
+  cycle.stop_after(duration, start)
+
+  def locate():
+    nonlocal pieces
+    cycle.locate(start)
+    pieces = cycle.pieces(0)
+    scheduler.at(cycle.due(0), 'quarter frame', send_quarter_frame, 0)
+
+  def follow(jump):
+    if clock.chase:
+      print('RELOCATING')
+      scheduler.cancel('quarter frame')
+      locate()
     else:
-      time.sleep(runuptimes[0]-now)
-
-  print('beginning')
-  while 1:
-    now = time.time()
-    if do_click and now >= next_click_time:
-      if click_counter % click_divs == 0:
-        send_click(outport, click_anote)
-      else:
-        send_click(outport, click_bnote)
-      click_counter += 1
-      next_click_time = start + click_counter * clicktime
-
-    # send mtc
-    if not infinite and now > end:
-      print('ENDING')
-      break
-    elif now >= next_full_frame_time:
-      tc.next()
-      send_full_frame(outport, tc)
-      next_frame_time = start + tc.frame_number * frametime
-      next_full_frame_time = next_frame_time + 10 * frametime
-    elif now > next_frame_time:
-      tc.next()
-      send_quarter_frames(outport, tc)
-      next_frame_time = start + tc.frame_number * frametime
-    # wait_until = min(next_frame_time, next_click_time, next_full_frame_time)
-    # time.sleep(max(0, wait_until - time.time()))
-    time.sleep(0.001)
+      scheduler.shift(jump)
+      cycle.origin += jump
+
+  def send_quarter_frame(deadline, count):
+    nonlocal pieces, next_pieces
+    piece = count % 8
+    jump = cycle.jump()
+    if jump is not None:
+      # this one goes back in the queue, to be moved or dropped with the rest
+      scheduler.at(deadline, 'quarter frame', send_quarter_frame, count)
+      follow(jump)
+      return
+    if count == 0:
+      send_full_frame(outport, cycle.table, cycle.tc.frames)
+    if piece == 0 and count > 0:
+      pieces = next_pieces
+    outport.send(pieces[piece])
+    if count == 0:
+      print(f'beginning at {cycle.tc}')
+    if piece == 0:
+      # build the next two frames while there is time to spare
+      next_pieces = cycle.pieces(count + 8)
+    scheduler.at(cycle.due(count + 1), 'quarter frame', send_quarter_frame, count + 1)
+
+  locate()
+  try:
+    while scheduler.queue:
+      scheduler.run(until=time.perf_counter_ns() + cycle.quarter_ns)
+      if cycle.stopped():
+        break
+      jump = cycle.jump()
+      if jump is not None:
+        follow(jump)
+    print('ENDING')
+  except KeyboardInterrupt:
+    print('STOPPED')
+  print('lateness:')
+  print(scheduler.report())
+  print(clock.status())
+  return scheduler
 
 
 @click.command()
@@ -126,16 +217,29 @@ def start_mtc(outport, fps, start_string, duration, click_data=None):
 @click.option('--division', default=4, help='set metronome division (beats per bar)')
 @click.option('--base_note', default=36, help='MIDI note of base click')
 @click.option('--accent_note', default=60, help='MIDI note of accent click')
-@click.option('--port',     '-p',   help='name of MIDI port to connect to')
-def main(fps, start, duration, metronome, bpm, division, base_note, accent_note, port):
-  if (port is None):
+@click.option('--port',     '-p',   multiple=True, help='name of MIDI port to connect to, give it more than once to send to several ports')
+@click.option('--spin', default=200, help='microseconds to spin before each message instead of sleeping, defaults to 200')
+@click.option('--backend', type=click.Choice(['rtmidi', 'mido', 'loopback']), help='MIDI backend, defaults to rtmidi when it is installed')
+@click.option('--clock', 'clock_kind', default='monotonic', type=click.Choice(['monotonic', 'audio', 'mtc', 'ltc']), help='what to keep time by: this computer, an audio device, or chase incoming mtc or ltc, defaults to monotonic')
+@click.option('--clock_port', help='(mtc clock) MIDI port the mtc to chase comes in on')
+@click.option('--audio_device', '-a', type=int, help='(audio and ltc clocks) id of the audio device')
+@click.option('--audio_channel', '-c', default=1, help='(ltc clock) audio channel with the ltc')
+def main(fps, start, duration, metronome, bpm, division, base_note, accent_note, port, spin, backend,
+         clock_kind, clock_port, audio_device, audio_channel):
+  if not port:
     print('You must specify a port name. (use --help or -h for more info)')
     print('Possible ports are:')
-    print(mido.get_output_names())
+    print(transport.get_output_names(backend))
 
     exit()
+  if clock_kind == 'mtc' and not clock_port:
+    print('The mtc clock needs --clock_port, the port the mtc to chase comes in on.')
+    print('Possible ports are:')
+    print(transport.get_input_names(backend))
+    exit()
 
-  outport = mido.open_output(port)
+  outport = transport.open_outputs(port, backend)
+  clock = open_clock(clock_kind, fps, clock_port, audio_device, audio_channel, backend)
   # wants fps as a string
   try:
     if metronome:
@@ -145,11 +249,17 @@ def main(fps, start, duration, metronome, bpm, division, base_note, accent_note,
           'base_note': base_note,
           'accent_note': accent_note
       }
-      start_mtc(outport, fps, start, float(duration), click_data)
+      start_mtc(outport, fps, start, float(duration), click_data, spin, clock)
     else:
-      start_mtc(outport, fps, start, float(duration))
+      start_mtc(outport, fps, start, float(duration), spin_us=spin, clock=clock)
   except:
     print('error somewhere')
+  outport.close()
+  clock.close()
+  if len(port) > 1:
+    print('send latency per port:')
+    print(outport.report())
 
 
-main()
+if __name__ == '__main__':
+  main()
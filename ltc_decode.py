@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# reads LTC back out of a wave file
+#
+# the signal is cut into intervals between zero crossings, every interval
+# is either a whole bit (a zero) or half a bit (two of them make a one),
+# and frames are found by looking for the sync word in the bit stream
+# everything works on whole numpy arrays, one block of samples at a time
+
+import click
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from timecode import Timecode
+
+from tools import LTC_SYNC_WORD
+
+# the sync word as it appears when the tape runs backwards
+LTC_SYNC_REVERSE = int(format(LTC_SYNC_WORD, '016b')[::-1], 2)
+
+BCD_WEIGHTS = numpy.array([1, 2, 4, 8])
+
+
+def read_wave(file_name, channel=1):
+  # returns the sample rate and the samples of one channel without reading them all in
+  # RIFF and RF64 files are both understood
+  with open(file_name, 'rb') as f:
+    riff = f.read(12)
+    if riff[:4] not in (b'RIFF', b'RF64') or riff[8:12] != b'WAVE':
+      raise ValueError(f'not a wave file: {file_name}')
+    rf64_data_length = None
+    fmt = None
+    while True:
+      chunk = f.read(8)
+      if len(chunk) < 8:
+        raise ValueError(f'no data in wave file: {file_name}')
+      name, size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+      if name == b'ds64':
+        body = f.read(size)
+        rf64_data_length = int.from_bytes(body[8:16], 'little')
+      elif name == b'fmt ':
+        body = f.read(size)
+        fmt = (int.from_bytes(body[0:2], 'little'), int.from_bytes(body[2:4], 'little'),
+               int.from_bytes(body[4:8], 'little'), int.from_bytes(body[14:16], 'little'))
+      elif name == b'data':
+        if size == 0xFFFFFFFF and rf64_data_length is not None:
+          size = rf64_data_length
+        data_offset = f.tell()
+        break
+      else:
+        f.seek(size + size % 2, 1)
+
+  format_tag, channels, rate, bits = fmt
+  bytes_per_sample = bits // 8
+  frame_count = size // (bytes_per_sample * channels)
+  if bits == 24:
+    # keep the raw bytes, they are widened one block at a time
+    raw = numpy.memmap(file_name, dtype=numpy.uint8, mode='r', offset=data_offset,
+                       shape=(frame_count, bytes_per_sample * channels))
+    return rate, raw[:, (channel - 1) * 3:channel * 3]
+  if bits == 8:
+    dtype = numpy.uint8
+  elif format_tag == 3:
+    dtype = '<f{}'.format(bytes_per_sample)
+  else:
+    dtype = '<i{}'.format(bytes_per_sample)
+  samples = numpy.memmap(file_name, dtype=dtype, mode='r', offset=data_offset, shape=(frame_count, channels))
+  return rate, samples[:, channel - 1]
+
+
+def sample_blocks(samples, block_size=1 << 22):
+  for start in range(0, len(samples), block_size):
+    block = numpy.asarray(samples[start:start + block_size])
+    if block.ndim == 2:
+      # 24 bit samples go into the top of an int32
+      block = (block[:, 0].astype(numpy.int32) << 8 | block[:, 1].astype(numpy.int32) << 16 |
+               block[:, 2].astype(numpy.int32) << 24) >> 8
+    yield start, block
+
+
+def crossings(start, block, threshold, last_high):
+  # the sample offsets where the signal crosses the threshold
+  high = block > threshold
+  changes = numpy.flatnonzero(high[1:] != high[:-1]) + 1
+  # the very start of the signal counts as an edge too
+  if last_high is None or high[0] != last_high:
+    changes = numpy.concatenate(([0], changes))
+  return changes + start, bool(high[-1])
+
+
+def transitions_to_bits(transitions, group=128):
+  # returns the bits and the sample each bit starts on
+  intervals = numpy.diff(transitions)
+  if len(intervals) == 0:
+    return numpy.empty(0, dtype=numpy.uint8), numpy.empty(0, dtype=numpy.int64)
+
+  # the longest interval nearby is a whole bit, even when the speed drifts
+  # every frame has zeroes in its sync word, and a group is most of a frame
+  padded = numpy.concatenate((intervals, numpy.zeros(-len(intervals) % group, dtype=intervals.dtype)))
+  group_max = padded.reshape(-1, group).max(axis=1)
+  group_max = numpy.maximum(group_max, numpy.concatenate((group_max[1:], group_max[-1:])))
+  group_max = numpy.maximum(group_max, numpy.concatenate((group_max[:1], group_max[:-1])))
+  bit_length = numpy.repeat(group_max, group)[:len(intervals)]
+  is_long = intervals * 4 > bit_length * 3
+
+  # short intervals pair up into ones, counting from the last long interval
+  shorts = numpy.cumsum(~is_long)
+  run_pos = shorts - numpy.maximum.accumulate(numpy.where(is_long, shorts, 0))
+  bit_ends = numpy.flatnonzero(is_long | (run_pos % 2 == 0) & (run_pos > 0))
+  bits = (~is_long[bit_ends]).astype(numpy.uint8)
+  starts = numpy.where(is_long[bit_ends], transitions[bit_ends], transitions[numpy.maximum(bit_ends - 1, 0)])
+  return bits, starts
+
+
+def bits_to_frames(bits, starts):
+  # finds every sync word, forwards or backwards, and decodes the frame that goes with it
+  # returns arrays of sample offsets, hours, minutes, seconds, frames and reverse flags
+  empty = numpy.empty(0, dtype=numpy.int64)
+  if len(bits) < 80:
+    return empty, empty, empty, empty, empty, empty.astype(bool)
+  codes = sliding_window_view(bits.astype(numpy.int64), 16) @ (1 << numpy.arange(15, -1, -1))
+
+  # forwards the sync word comes after the 64 data bits
+  forward = numpy.flatnonzero(codes == LTC_SYNC_WORD)
+  forward = forward[forward >= 64]
+  forward_rows = bits[(forward - 64)[:, None] + numpy.arange(64)]
+  # backwards it comes first and the data bits follow in reverse
+  reverse = numpy.flatnonzero(codes == LTC_SYNC_REVERSE)
+  reverse = reverse[reverse + 80 <= len(bits)]
+  reverse_rows = bits[(reverse + 16)[:, None] + numpy.arange(64)][:, ::-1]
+
+  rows = numpy.concatenate((forward_rows, reverse_rows)).astype(numpy.int64)
+  offsets = numpy.concatenate((starts[forward - 64], starts[reverse]))
+  is_reverse = numpy.concatenate((numpy.zeros(len(forward), dtype=bool), numpy.ones(len(reverse), dtype=bool)))
+
+  units = [rows[:, pos:pos + 4] @ BCD_WEIGHTS for pos in (0, 16, 32, 48)]
+  tens = [rows[:, pos:pos + n] @ BCD_WEIGHTS[:n] for pos, n in ((8, 2), (24, 3), (40, 3), (56, 2))]
+  frs, secs, mins, hrs = [u + 10 * t for u, t in zip(units, tens)]
+
+  # anything that isn't a real timecode came from a false sync match
+  valid = (units[0] < 10) & (units[1] < 10) & (units[2] < 10) & (units[3] < 10)
+  valid &= (frs < 30) & (secs < 60) & (mins < 60) & (hrs < 24)
+  order = numpy.argsort(offsets[valid], kind='stable')
+  return tuple(a[valid][order] for a in (offsets, hrs, mins, secs, frs, is_reverse))
+
+
+def decode_frames(samples, block_size=1 << 22, carry=400):
+  # yields the decoded frames one block of samples at a time
+  # the last few hundred transitions of a block are decoded again with the
+  # next one, so frames that straddle blocks are not lost
+  transitions = numpy.empty(0, dtype=numpy.int64)
+  last_high = None
+  last_offset = -1
+  blocks = sample_blocks(samples, block_size)
+  while True:
+    start, block = next(blocks, (len(samples), None))
+    if block is None:
+      # and so does the very end, which finishes off the last bit
+      new_transitions = numpy.array([len(samples)], dtype=numpy.int64)
+    else:
+      # the threshold sits halfway between the levels, so unsigned and float data work too
+      threshold = (float(block.max()) + float(block.min())) / 2
+      new_transitions, last_high = crossings(start, block, threshold, last_high)
+    transitions = numpy.concatenate((transitions, new_transitions))
+    frames = bits_to_frames(*transitions_to_bits(transitions))
+    keep = frames[0] > last_offset
+    frames = tuple(a[keep] for a in frames)
+    if len(frames[0]):
+      last_offset = frames[0][-1]
+      yield frames
+    if block is None:
+      return
+    transitions = transitions[-carry:]
+
+
+def guess_fps(frames):
+  # the highest frame number tells 24, 25 and 30 apart
+  # 29.97 looks just like 30 and has to be asked for
+  highest = int(frames.max()) if len(frames) else 29
+  if highest < 24:
+    return '24'
+  if highest < 25:
+    return '25'
+  return '30'
+
+
+def ltc_decode(file_name, fps=None, channel=1):
+  # yields (sample_offset, Timecode) for every frame in the file
+  # fps can't be seen in the bits, so without it the highest frame number decides
+  rate, samples = read_wave(file_name, channel)
+  for offsets, hrs, mins, secs, frs, is_reverse in decode_frames(samples):
+    if fps is None:
+      fps = guess_fps(frs)
+    for offset, h, m, s, f in zip(offsets, hrs, mins, secs, frs):
+      yield int(offset), Timecode(fps, f'{h:02d}:{m:02d}:{s:02d}:{f:02d}')
+
+
+@click.command()
+@click.argument('file_name')
+@click.option('--fps', '-f', help='frames per second, guessed from the frame numbers if not given')
+@click.option('--channel', '-c', default=1, help='audio channel with the ltc, defaults to 1')
+@click.option('--all', '-a', 'show_all', is_flag=True, help='print every frame instead of just the jumps')
+def main(file_name, fps, channel, show_all):
+  rate, samples = read_wave(file_name, channel)
+  print(f'DECODING LTC: {file_name} ({len(samples)} samples at {rate}Hz)')
+  count = 0
+  expected = None
+  last_reverse = None
+  first = last = None
+  for offsets, hrs, mins, secs, frs, is_reverse in decode_frames(samples):
+    if fps is None:
+      fps = guess_fps(frs)
+    for offset, h, m, s, f, reverse in zip(offsets, hrs, mins, secs, frs, is_reverse):
+      tc = Timecode(fps, f'{h:02d}:{m:02d}:{s:02d}:{f:02d}')
+      count += 1
+      # only report where the timecode doesn't simply carry on
+      jumped = expected is not None and tc.frames != expected
+      if show_all or jumped or reverse != last_reverse:
+        direction = 'reverse' if reverse else 'forward'
+        print(f'{offset:>12} {offset / rate:>12.3f}s  {tc}  {direction}{"  JUMP" if jumped else ""}')
+      expected = tc.frames - 1 if reverse else tc.frames + 1
+      last_reverse = reverse
+      first = first or tc
+      last = tc
+  print(f'DONE: {count} frames at {fps}fps, {first} - {last}')
+
+
+if __name__ == '__main__':
+  main()
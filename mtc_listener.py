@@ -4,20 +4,18 @@ import click
 import mido
 import tools
 
-# create a global accumulator for quarter_frames
-quarter_frames = [0, 0, 0, 0, 0, 0, 0, 0]
+decoder = tools.QuarterFrameDecoder()
 
 
 def handle_message(message):
   if message.type == 'quarter_frame':
-    quarter_frames[message.frame_type] = message.frame_value
-    if message.frame_type == 7:
-      tc = tools.mtc_decode_quarter_frames(quarter_frames)
-      print('QF:', tc)
+    if decoder.update(message.frame_type << 4 | message.frame_value) is not None:
+      print('QF:', decoder.timecode)
   elif message.type == 'sysex':
     # check to see if this is a timecode frame
     if len(message.data) == 8 and message.data[0:4] == (127, 127, 1, 1):
       data = message.data[4:]
+      decoder.reset()
       tc = tools.mtc_decode(data)
       print('FF:', tc)
   else:
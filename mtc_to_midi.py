@@ -21,21 +21,40 @@ The hex bytes may be followed by a space and an optional comment or a newline ch
 Everything following the hex bytes will be ignored
 Timecode must be in HH:MM:SS:FF format (FF means frames)
 
+Playback compiles the configuration file into a binary cue file next to it
+(CONFIG.cues) and uses that until the configuration file changes, so big show
+files only get parsed once. --compile does it ahead of time.
+
 '''
 
+import bisect
+import hashlib
 import os
-from time import sleep, time
+import queue
+import struct
+from time import perf_counter_ns
 import click
 import mido
+import numpy
 import tools
+import transport
+from clock import Pll, frame_ns
+from scheduler import LatenessHistogram, Scheduler
 from timecode import Timecode
 
-# create a global accumulator for quarter_frames
-quarter_frames = [0, 0, 0, 0, 0, 0, 0, 0]
+# when nothing arrives for this many frames the timecode has stopped
+STALL_FRAMES = 1
+# the timecode moves a frame at a time, more than this forward is a jump
+JUMP_FRAMES = 2
+
+# (source, data, timestamp) for every message from the ports
+inbox = queue.SimpleQueue()
 
-# create global timecode object
-tc = Timecode(framerate=24, frames=1)
-tc_ts = time()
+# how long each stage takes, in ns
+#   queue    -- from a message arriving until this thread picks it up
+#   decode   -- from a timecode message arriving until it has been acted on
+#   dispatch -- from an event being due until it has been sent
+stats = {stage: LatenessHistogram() for stage in ('queue', 'decode', 'dispatch')}
 msg_log = []
 
 mtc = None
@@ -53,22 +72,217 @@ class Event:
     self.msg = message
 
 
-def update_timecode(message):
-  global tc  # because we reassign it here
-  global tc_ts  # because we reassign it here
-  if message.type == 'quarter_frame':
-    quarter_frames[message.frame_type] = message.frame_value
-    if message.frame_type == 7:
-      tc = tools.mtc_decode_quarter_frames(quarter_frames)
-      tc_ts = time()
-      # print('QF:', tc)
-  elif message.type == 'sysex':
-    # check to see if this is a timecode frame
-    if len(message.data) == 8 and message.data[0:4] == (127, 127, 1, 1):
-      data = message.data[4:]
-      tc = tools.mtc_decode(data)
-      tc_ts = time()
-      # print('FF:', tc)
+# compiled config files (cue files) are a header followed by the events,
+# sorted, as CUE_DTYPE records: the timecode packed into a uint32 as
+# HH << 24 | MM << 16 | SS << 8 | FF, which sorts the same at every rate,
+# and the message bytes, padded to three
+# the header keeps the sha256 of the text they came from, so they are only
+# used while it hasn't changed
+CUE_MAGIC = b'MTC2MIDI'
+CUE_VERSION = 1
+CUE_HEADER = struct.Struct('<8sII32s')  # magic, version, event count, sha256
+CUE_DTYPE = numpy.dtype([('tc', '<u4'), ('msg', 'u1', (3,))])
+
+
+def message_length(status):
+  # how many bytes a MIDI message has, from its status byte
+  if status < 0xc0 or 0xe0 <= status < 0xf0 or status == 0xf2:
+    return 3
+  if status < 0xe0 or status in (0xf1, 0xf3):
+    return 2
+  return 1
+
+
+class EventIndex:
+  # the events sorted by time, and their frame numbers at the rate the mtc
+  # is running, so finding the next event after any timecode is a bisect
+  # HH:MM:SS:FF sorts the same at every rate, the frame numbers don't, so
+  # they are worked out again whenever the rate changes
+  # cues is a sorted CUE_DTYPE array, which can be mapped straight from a cue file
+  def __init__(self, cues):
+    self.cues = cues
+    tc = numpy.asarray(cues['tc'], dtype=numpy.int64)
+    self.parts = numpy.stack([tc >> 24, (tc >> 16) & 255, (tc >> 8) & 255, tc & 255], axis=1)
+    self.framerate = None
+    self.frames = []
+
+  @classmethod
+  def from_events(cls, events):
+    cues = numpy.zeros(len(events), dtype=CUE_DTYPE)
+    parts = numpy.array([Timecode.parse_timecode(event.tc) for event in events], dtype=numpy.uint32).reshape(-1, 4)
+    cues['tc'] = parts[:, 0] << 24 | parts[:, 1] << 16 | parts[:, 2] << 8 | parts[:, 3]
+    msgs = b''.join(event.msg.ljust(3, b'\0') for event in events)
+    cues['msg'] = numpy.frombuffer(msgs, dtype=numpy.uint8).reshape(-1, 3)
+    # the file doesn't have to be in order, events at the same time stay in file order
+    return cls(cues[numpy.argsort(cues['tc'], kind='stable')])
+
+  def message(self, i):
+    msg = self.cues[i]['msg']
+    return bytes(msg[:message_length(msg[0])])
+
+  def event(self, i):
+    hrs, mins, secs, frs = self.parts[i]
+    return Event(f'{hrs:02d}:{mins:02d}:{secs:02d}:{frs:02d}', self.message(i))
+
+  def __len__(self):
+    return len(self.cues)
+
+  def locate(self, frames, framerate):
+    # the position of the first event after frames
+    if framerate != self.framerate:
+      self.framerate = framerate
+      self.frames = tools.tc_to_frames_array(Timecode(framerate), *self.parts.T).tolist()
+    return bisect.bisect_right(self.frames, frames)
+
+
+class MtcPosition:
+  # where incoming mtc says we are
+  # frames is the last timecode as an integer frame count (starting at 1,
+  # like Timecode.frames) and framerate the rate it is counted at
+  # the timecode only comes every couple of frames, so a pll follows the
+  # position (in ns from 00:00:00:00) against perf_counter_ns, so it can be
+  # read at any moment, and turned round to say when an event is due
+  def __init__(self):
+    self.decoder = tools.QuarterFrameDecoder()
+    self.frames = 1
+    self.framerate = '24'
+    self.frame_length = float(frame_ns(self.framerate))
+    self.pll = Pll()
+    self.last_seen = None
+
+  def update(self, data, timestamp):
+    # data is the raw bytes of one MIDI message, timestamp when it arrived
+    # returns True when it completed a timecode
+    if data[0] == 0xf1:
+      self.last_seen = timestamp
+      frames = self.decoder.update(data[1])
+      if frames is not None:
+        late = self.decoder.OFFSET if self.decoder.direction > 0 else 0
+        self.set(frames, self.decoder.framerate, timestamp, late)
+        return True
+    elif data[0] == 0xf0:
+      # check to see if this is a timecode frame
+      if len(data) == 10 and data[1:5] == tools.MTC_FULL_FRAME_HEADER[1:]:
+        self.last_seen = timestamp
+        # the quarter frames that come next are for wherever this says
+        self.decoder.reset()
+        self.set(*tools.mtc_frames(data[5:9]), timestamp, 0)
+        return True
+    return False
+
+  def set(self, frames, framerate, timestamp, late):
+    # late is how far into frames (in frames) it was when the timecode arrived
+    self.frames = frames
+    if framerate != self.framerate:
+      self.framerate = framerate
+      self.frame_length = float(frame_ns(framerate))
+    self.pll.update(timestamp, round((self.frames - 1 + late) * self.frame_length))
+
+  def current_frames(self, now):
+    # the frame the timecode is in at perf_counter_ns now
+    # once the timecode stops, it stays a little after the last message
+    if self.pll.local is None:
+      return self.frames
+    now = min(now, self.last_seen + STALL_FRAMES * self.frame_length)
+    return int(self.pll.estimate(now) // self.frame_length) + 1
+
+  def due_at(self, frames):
+    # the perf_counter_ns time the timecode reaches the start of frames,
+    # or None when the timecode has stopped
+    if self.pll.local is None or perf_counter_ns() - self.last_seen > STALL_FRAMES * self.frame_length:
+      return None
+    return round(self.pll.local_time((frames - 1) * self.frame_length))
+
+
+def parse_events(lines):
+  events = []
+  for line in lines:
+    line = line.strip()
+    if line == '':
+      continue
+    if line[0] == '#':
+      continue
+
+    # everything after the bytes is ignored
+    results = line.split(' ', 2)
+    if len(results) < 2:
+      print(f'IGNORING invalid configuration line: {line}')
+      print('\tline should be in this format: HH:MM:SS:FF B1,B2,B3')
+      continue
+    event_tc = results[0]
+    event_hex = results[1]
+    try:
+      # mido checks the bytes make a real message, then only the bytes are kept
+      event_msg = bytes(mido.Message.from_hex(event_hex, sep=',').bytes())
+      Timecode.parse_timecode(event_tc)
+    except (ValueError, IndexError):
+      print(f'IGNORING invalid configuration line: {line}')
+      print('\tcould not be parsed into a timecode and a MIDI command')
+      continue
+    if len(event_msg) > 3:
+      print(f'IGNORING invalid configuration line: {line}')
+      print('\tMIDI commands can be at most three bytes')
+      continue
+    events.append(Event(event_tc, event_msg))
+  return events
+
+
+def cue_file(config):
+  return config + '.cues'
+
+
+def write_cues(file_name, cues, digest):
+  # written to the side and moved into place, so a reader never sees half a file
+  temp_name = file_name + '.tmp'
+  with open(temp_name, 'wb') as f:
+    f.write(CUE_HEADER.pack(CUE_MAGIC, CUE_VERSION, len(cues), digest))
+    f.write(numpy.ascontiguousarray(cues, dtype=CUE_DTYPE).tobytes())
+  os.replace(temp_name, file_name)
+
+
+def read_cues(file_name, digest=None):
+  # the cues in a cue file, mapped rather than read, or None if there is no
+  # usable cue file (or it was made from different text than digest)
+  try:
+    with open(file_name, 'rb') as f:
+      magic, version, count, file_digest = CUE_HEADER.unpack(f.read(CUE_HEADER.size))
+      size = os.fstat(f.fileno()).st_size
+  except (OSError, struct.error):
+    return None
+  if magic != CUE_MAGIC or version != CUE_VERSION:
+    return None
+  # a file cut short (or added to) can't be mapped as count cues
+  if size != CUE_HEADER.size + count * CUE_DTYPE.itemsize:
+    return None
+  if digest is not None and file_digest != digest:
+    return None
+  if count == 0:
+    return numpy.zeros(0, dtype=CUE_DTYPE)
+  return numpy.memmap(file_name, dtype=CUE_DTYPE, mode='r', offset=CUE_HEADER.size, shape=(count,))
+
+
+def compile_events(config):
+  # parses the config file and saves the cue file next to it
+  with open(config, 'rb') as f:
+    text = f.read()
+  events = EventIndex.from_events(parse_events(text.decode().splitlines()))
+  write_cues(cue_file(config), events.cues, hashlib.sha256(text).digest())
+  return events
+
+
+def load_events(config):
+  # the events from the cue file if it was made from this text,
+  # otherwise the text is parsed and the cue file made again
+  with open(config, 'rb') as f:
+    text = f.read()
+  cues = read_cues(cue_file(config), hashlib.sha256(text).digest())
+  if cues is not None:
+    return EventIndex(cues)
+  try:
+    return compile_events(config)
+  except OSError:
+    # somewhere we can't write, so no cue file this time
+    return EventIndex.from_events(parse_events(text.decode().splitlines()))
 
 
 last_line_length = 0
@@ -80,9 +294,11 @@ def status(s):
   last_line_length = len(s) + 1
 
 
-# switch to callback method!
-# based on https://mido.readthedocs.io/en/latest/ports.html#callbacks
-def listen(mtc_port, midi_port, config, record_mode):
+def report():
+  return '\n'.join(f'  {stage}: {stage_stats}' for stage, stage_stats in stats.items())
+
+
+def listen(mtc_port, midi_port, config, record_mode, backend=None):
   global mtc, midi
 
   # port.callback = print_message
@@ -95,115 +311,104 @@ MTC -> MIDI ({verb})
   
 STOP with ^C (Ctrl+C)\n\n''')
 
-  mtc = mido.open_input(mtc_port, autoreset=True)
-  old_tc = tc
-  events = []
+  # the ports call back from their own threads with every message, which is
+  # queued with its arrival time for this thread to decode and act on
+  mtc = transport.open_input(mtc_port, lambda data, timestamp: inbox.put(('mtc', data, timestamp)), backend)
+  timecode = MtcPosition()
+  waiter = Scheduler()
+  old_position = None
+  old_framerate = None
+  old_resyncs = 0
+  events = EventIndex.from_events([])
   event_cursor = 0
   next_event = None
+  next_frames = None
   midi = None
 
   # prepare main midi port
-  if mtc_port != midi_port:
-    if record_mode:
-      midi = mido.open_input(midi_port, autoreset=True)
-    else:
-      midi = mido.open_output(midi_port, autoreset=True)
-
+  # when recording, one port can bring in both the mtc and the events
   if not record_mode:
-    # parse the config file
-    events = []
-    with open(config, 'r') as f:
-      for line in f.readlines():
-        line = line.strip()
-        if line == '':
-          continue
-        if line[0] == '#':
-          continue
-
-        # everything after the bytes is ignored
-        results = line.split(' ', 2)
-        if len(results) < 2:
-          print(f'IGNORING invalid configuration line: {line}')
-          print('\tline should be in this format: HH:MM:SS:FF B1,B2,B3')
-          continue
-        event_tc = results[0]
-        event_hex = results[1]
-        try:
-          event_msg = mido.Message.from_hex(event_hex, sep=',')
-          events.append(Event(event_tc, event_msg))
-        except ValueError:
-          print(f'IGNORING invalid configuration line: {line}')
-          print('\tcould not be parsed into a MIDI command')
+    midi = transport.open_output(midi_port, backend)
+  elif mtc_port != midi_port:
+    midi = transport.open_input(midi_port, lambda data, timestamp: inbox.put(('midi', data, timestamp)), backend)
 
+  if not record_mode:
+    events = load_events(config)
     if len(events) == 0:
       print(f'No events found in configuration file: {config}')
       return
     else:
-      first_tc = events[0].tc
-      last_tc = events[-1].tc
+      first_tc = events.event(0).tc
+      last_tc = events.event(len(events) - 1).tc
       print(f'Processed: {config}')
       print(f'Found {len(events)} MIDI events in range {first_tc} - {last_tc}')
       print()
 
   # start main mtc loop
+  # everything in here works on integer frame counts
+  # Timecode objects are only made for printing
   while 1:
+    # sleep until a message comes in or the next event is nearly due
+    timeout = None
+    if next_event is not None:
+      due = timecode.due_at(next_frames)
+      if due is not None:
+        timeout = max(0, due - perf_counter_ns() - waiter.spin_ns) / 1e9
+    try:
+      source, data, timestamp = inbox.get(timeout=timeout)
+    except queue.Empty:
+      source = data = None
+    else:
+      stats['queue'].add(perf_counter_ns() - timestamp)
+
     # update the timecode as soon as possible
-    # by grabbing mtc events first
-    mtc_msg = mtc.poll()
-    if mtc_msg is not None:
-      update_timecode(mtc_msg)
-      if old_tc != tc:
-        line = f'{tc}'
+    if source == 'mtc':
+      timecode.update(data, timestamp)
+      position, framerate = timecode.frames, timecode.framerate
+      if position != old_position or framerate != old_framerate or timecode.pll.resyncs != old_resyncs:
+        line = f'{Timecode(framerate, frames=position)}'
 
         # going back in time should reset events
-        if old_tc > tc:
+        if framerate == old_framerate and position < old_position:
           print('\n-- TIME WENT BACKWARD --')
           next_event = None
+        # and a new rate gives every event a new frame number
+        if framerate != old_framerate:
+          next_event = None
+        # jumping forward (or the pll taking a jump all at once) starts again
+        # from where we are, rather than sending everything skipped over
+        elif position > old_position + JUMP_FRAMES or timecode.pll.resyncs != old_resyncs:
+          print('\n-- TIME JUMPED --')
+          next_event = None
 
         # if there is no upcoming event, compute one now
+        # events in the frame we are already part way through are let go
         if next_event is None:
-          for i, event in enumerate(events):
-            if event.tc > tc:
-              next_event = event
-              event_cursor = i
-              break  # this inner for loop
+          event_cursor = events.locate(timecode.current_frames(perf_counter_ns()), framerate)
+          if event_cursor < len(events):
+            next_event = events.event(event_cursor)
+            next_frames = events.frames[event_cursor]
 
         if next_event is not None:
-          line += f' NEXT EVENT: {next_event.tc} -> {next_event.msg}'
+          line += f' NEXT EVENT: {next_event.tc} -> {next_event.msg.hex(" ").upper()}'
         elif not record_mode:
           line += ' NO UPCOMING EVENTS... still listening in case the timeline resets.'
 
         status(line)
-        old_tc = tc
-
-    # make sure we understand the real absolute time right now because
-    # we want our events to be as accurate as possible, and the timecode
-    # might not show up as frequently as we would like
-    now = time()
-    elapsed = now - tc_ts  # time since the last timecode was received
-
-    # if the timecode has been stopped longer than one second
-    # assume it is really stopped and ignore the "corrected" time
-    if elapsed > 1:
-      tc_now = tc
-    else:
-      additional_frames = round(elapsed / 24)
-      tc_now = tc + additional_frames  # Timecode class overrides the `+` operator
+        old_position = position
+        old_framerate = framerate
+        old_resyncs = timecode.pll.resyncs
+      stats['decode'].add(perf_counter_ns() - timestamp)
 
     # now that we know what time it is, do the other MIDI stuff
     if record_mode:
-      # try to grab recordable events from the midi port
-      # or use the event we already received from the mtc port
-      # (one port can do both jobs)
-      if midi is None:
-        midi_msg = mtc_msg
-      else:
-        midi_msg = midi.poll()
-      if midi_msg is not None:
-        if midi_msg.type != 'sysex' and midi_msg.type != 'quarter_frame':
-          comment = f'-> {midi_msg}'
-          h = midi_msg.hex(sep=",")
-          line = f'{tc_now} {h} # {comment}'
+      # anything from the midi port is recordable, and so is anything
+      # that isn't timecode on the mtc port (one port can do both jobs)
+      if data is not None and (source == 'midi' or midi is None):
+        if data[0] != 0xf0 and data[0] != 0xf1:
+          comment = f'-> {mido.Message.from_bytes(data)}'
+          h = data.hex(',').upper()
+          line = f'{Timecode(timecode.framerate, frames=timecode.current_frames(timestamp))} {h} # {comment}'
           msg_log.append(line)
           status(line)
           print()
@@ -212,30 +417,38 @@ STOP with ^C (Ctrl+C)\n\n''')
 
     else:
       # send pre-recorded MIDI events
-      while next_event is not None and tc_now > next_event.tc:
+      # the timecode only comes every couple of frames, so rather than waiting
+      # for it to pass an event, each event goes out when the pll says its
+      # frame starts
+      while next_event is not None:
+        due = timecode.due_at(next_frames)
+        if due is None or due - perf_counter_ns() > waiter.spin_ns:
+          break
+        waiter.wait_until(due)
         midi_msg = next_event.msg
         midi.send(midi_msg)
-        line = f'{tc} {midi_msg.hex()}'
+        stats['dispatch'].add(perf_counter_ns() - due)
+        line = f'{Timecode(timecode.framerate, frames=next_frames)} {midi_msg.hex(" ").upper()}'
         status(line)
         print()
 
         event_cursor += 1
         if event_cursor < len(events):
-          next_event = events[event_cursor]
+          next_event = events.event(event_cursor)
+          next_frames = events.frames[event_cursor]
         else:
           next_event = None
           # print('Finished sending all events.')
           # return
 
-    # give the CPU just a bit of a rest
-    sleep(0.0001)
-
 
 def quit():
   if mtc is not None:
     mtc.close()
   if midi is not None:
     midi.close()
+  print('latency:')
+  print(report())
   exit()
 
 
@@ -245,31 +458,30 @@ def quit():
 @click.option('-r', '--record', default=False, is_flag=True, help='sets record mode, defaults to off')
 @click.option('-l', '--list-ports', is_flag=True, help='lists the available MIDI ports')
 @click.option('-c', '--config', default='events.mtc2midi', help='the configuration file to use for storing/reading MIDI events')
-def main(mtc, midi, config, record, list_ports):
+@click.option('--backend', type=click.Choice(['rtmidi', 'mido', 'loopback']), help='MIDI backend, defaults to rtmidi when it is installed')
+@click.option('--compile', 'compile_only', is_flag=True, help='just compile the configuration file to a cue file (CONFIG.cues) and exit, playback does this whenever the file has changed')
+def main(mtc, midi, config, record, list_ports, backend, compile_only):
   """This script will listen to MTC over a MIDI port and record/execute MIDI commands
 based on a configuration file.
 
 Open the source code to see an example of a configuration file.
   """
+  if compile_only:
+    events = compile_events(config)
+    print(f'Compiled {len(events)} MIDI events to {cue_file(config)}')
+    exit()
+
   if list_ports or midi is None:
     print('---------------------')
     print('Available INPUT ports')
     print('---------------------')
-    ports = []
-    for name in mido.get_input_names():
-      if name not in ports:
-        ports.append(name)
-    for port in ports:
+    for port in transport.get_input_names(backend):
       print(port)
 
     print('---------------------')
     print('Available OUTPUT ports')
     print('---------------------')
-    ports = []
-    for name in mido.get_output_names():
-      if name not in ports:
-        ports.append(name)
-    for port in ports:
+    for port in transport.get_output_names(backend):
       print(port)
     exit()
 
@@ -287,7 +499,7 @@ Open the source code to see an example of a configuration file.
     exit()
 
   try:
-    listen(mtc, midi, config, record_mode=record)
+    listen(mtc, midi, config, record_mode=record, backend=backend)
     print()
     quit()
   except KeyboardInterrupt:
@@ -297,4 +509,5 @@ Open the source code to see an example of a configuration file.
     quit()
 
 
-main()
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# plays LTC live on an audio device instead of rendering a wave file
+# frames are rendered a little ahead of the playhead into a ring buffer
+# and the audio callback only ever copies samples out of it
+
+import click
+import numpy
+import threading
+import time
+from timecode import Timecode
+
+from generate_ltc import half_bits_per_sample, pcm_chunks, sample_levels, write_wave_file
+
+# sounddevice is only needed when playing to real hardware
+try:
+  import sounddevice as sd
+except ImportError:
+  sd = None
+
+
+class RingBuffer:
+  # single producer, single consumer sample buffer
+  # the producer blocks while it is full, the consumer never blocks
+  def __init__(self, size, dtype=numpy.int16):
+    self.buffer = numpy.zeros(size, dtype=dtype)
+    self.size = size
+    self.written = 0
+    self.read_count = 0
+    self.finished = False
+    self.lock = threading.Condition()
+
+  def fill(self):
+    return self.written - self.read_count
+
+  def write(self, samples):
+    offset = 0
+    while offset < len(samples):
+      with self.lock:
+        while self.fill() == self.size and not self.finished:
+          self.lock.wait()
+        if self.finished:
+          return
+        count = min(len(samples) - offset, self.size - self.fill())
+        start = self.written % self.size
+        first = min(count, self.size - start)
+        self.buffer[start:start + first] = samples[offset:offset + first]
+        self.buffer[:count - first] = samples[offset + first:offset + count]
+        self.written += count
+      offset += count
+
+  def read(self, out):
+    # copies as many samples as are ready into out and returns the count
+    with self.lock:
+      count = min(len(out), self.fill())
+      start = self.read_count % self.size
+      first = min(count, self.size - start)
+      out[:first] = self.buffer[start:start + first]
+      out[first:count] = self.buffer[:count - first]
+      self.read_count += count
+      self.lock.notify()
+    return count
+
+  def finish(self):
+    with self.lock:
+      self.finished = True
+      self.lock.notify_all()
+
+
+class HeadlessStream:
+  # stands in for sounddevice.OutputStream without any audio hardware
+  # the callback is called at the pace a real device would call it
+  def __init__(self, samplerate, blocksize, channels, dtype, callback, capture=False, **kwargs):
+    self.samplerate = samplerate
+    self.blocksize = blocksize
+    self.channels = channels
+    self.dtype = dtype
+    self.callback = callback
+    self.captured = [] if capture else None
+    self.running = False
+    self.thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.do_thread)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    if self.thread is not None:
+      self.thread.join()
+
+  def do_thread(self):
+    outdata = numpy.zeros((self.blocksize, self.channels), dtype=self.dtype)
+    block_time = self.blocksize / self.samplerate
+    next_block = time.perf_counter()
+    while self.running:
+      self.callback(outdata, self.blocksize, None, None)
+      if self.captured is not None:
+        self.captured.append(outdata.copy())
+      next_block += block_time
+      time.sleep(max(0, next_block - time.perf_counter()))
+
+
+class LtcPlayer:
+  def __init__(self, fps, start, rate=48000, duration=0, latency=0.05, blocksize=256, channel=1, channels=1):
+    self.tc = Timecode(fps, start)
+    self.timing = half_bits_per_sample(fps, rate)
+    self.rate = rate
+    # without a duration, play a full day of timecode
+    self.total_samples = int(rate * (duration if duration > 0 else 24 * 60 * 60))
+    self.blocksize = blocksize
+    self.channel = channel
+    self.channels = channels
+    # the latency budget is how far ahead of the playhead we render
+    self.ring = RingBuffer(max(int(rate * latency), blocksize * 2))
+    self.levels = sample_levels(32767, -32768, 16)
+    self.block = numpy.zeros(blocksize, dtype=numpy.int16)
+    self.done = threading.Event()
+    self.render_thread = None
+
+    # stats
+    self.blocks = 0
+    self.underruns = 0
+    self.device_status = 0
+    self.min_fill = self.ring.size
+    self.played = 0
+
+  def render(self):
+    for chunk_start, chunk in pcm_chunks(self.tc, self.timing, self.total_samples, self.levels, chunk_size=self.blocksize):
+      self.ring.write(chunk.view('<i2')[:, 0])
+      if self.ring.finished:
+        return
+    self.ring.finish()
+
+  def callback(self, outdata, frames, time_info, status):
+    if status:
+      self.device_status += 1
+    if not self.ring.finished:
+      self.min_fill = min(self.min_fill, self.ring.fill())
+    count = self.ring.read(self.block[:frames])
+    outdata.fill(0)
+    outdata[:count, self.channel - 1] = self.block[:count]
+    self.blocks += 1
+    self.played += count
+    if count < frames:
+      if self.ring.finished:
+        self.done.set()
+      else:
+        self.underruns += 1
+
+  def start(self):
+    self.render_thread = threading.Thread(target=self.render)
+    self.render_thread.start()
+    # don't start the device until the latency budget is rendered
+    while self.ring.fill() < self.ring.size and not self.ring.finished:
+      time.sleep(0.001)
+
+  def stop(self):
+    self.ring.finish()
+    self.render_thread.join()
+
+  def play(self, stream_class, **kwargs):
+    self.start()
+    stream = stream_class(samplerate=self.rate, blocksize=self.blocksize, channels=self.channels,
+                          dtype='int16', callback=self.callback, **kwargs)
+    try:
+      with stream:
+        while not self.done.wait(0.5):
+          self.status()
+    except KeyboardInterrupt:
+      pass
+    self.stop()
+    print()
+    return stream
+
+  def status(self):
+    tc = Timecode(self.tc.framerate, frames=self.tc.frames + int(self.played * self.timing) // 160)
+    print(f'\r{tc}  blocks: {self.blocks}  underruns: {self.underruns}  '
+          f'device status flags: {self.device_status}  lowest buffer: {self.min_fill} samples ', end='')
+
+
+@click.command()
+@click.option('--fps', '-f',   default='24', help='frames per second, defaults to 24')
+@click.option('--start', '-s', default='00:00:00:00',  help='start timecode, defaults to 00:00:00:00')
+@click.option('--duration', '-d', default=0.0, help='duration in seconds, defaults to 0 (24 hours)')
+@click.option('--rate', '-r',   default=48000, help='sample rate, defaults to 48000')
+@click.option('--latency', '-l', default=50.0, help='how far ahead to render in milliseconds, defaults to 50')
+@click.option('--blocksize', default=256, help='samples per audio callback, defaults to 256')
+@click.option('--audio_device', '-a', type=int, help='id of selected audio device')
+@click.option('--audio_channel', '-c', default=1, help='selected audio channel')
+@click.option('--headless', is_flag=True, help='play to a stand-in device without audio hardware')
+@click.option('--capture', help='(headless only) save what was played to this wave file')
+def main(fps, start, duration, rate, latency, blocksize, audio_device, audio_channel, headless, capture):
+  fps = float(fps)
+  if headless:
+    channels = audio_channel
+  else:
+    if sd is None:
+      print('sounddevice is not installed, use --headless to run without audio hardware')
+      exit()
+    if audio_device is None:
+      print('You must select an audio device.')
+      print('Possible output devices are:')
+      for i, device in enumerate(sd.query_devices()):
+        if device['max_output_channels'] > 0:
+          print(f' # {i} -- {device["name"]}, {device["max_output_channels"]} channels out')
+      exit()
+    channels = sd.query_devices(audio_device)['max_output_channels']
+
+  player = LtcPlayer(fps, start, rate=rate, duration=duration, latency=latency / 1000,
+                     blocksize=blocksize, channel=audio_channel, channels=channels)
+  print(f'PLAYING LTC: {start} at {fps}fps, {rate}Hz, rendering {player.ring.size} samples ahead')
+  if headless:
+    stream = player.play(HeadlessStream, capture=capture is not None)
+    if capture is not None:
+      data = numpy.concatenate(stream.captured)[:player.played, audio_channel - 1]
+      write_wave_file(capture, data, rate=rate, bits=16)
+  else:
+    player.play(sd.OutputStream, device=audio_device, latency=latency / 1000)
+
+  print(f'DONE: {player.blocks} blocks, {player.underruns} underruns, lowest buffer {player.min_fill} samples')
+
+
+if __name__ == '__main__':
+  main()
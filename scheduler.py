@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# a deadline scheduler for realtime midi output
+#
+# things to send are queued with the time they should go out on the
+# monotonic clock, the scheduler sleeps until just before the earliest one
+# and then spins for the last stretch, and every send is timed against its
+# deadline so we can see how much jitter there really is
+
+import heapq
+import itertools
+import time
+
+
+class LatenessHistogram:
+  # counts how late things happened in microsecond buckets
+  # the last bucket holds everything too late for the others
+  def __init__(self, bucket_us=10, buckets=100):
+    self.bucket_us = bucket_us
+    self.counts = [0] * (buckets + 1)
+    self.count = 0
+    self.total_ns = 0
+    self.min_ns = None
+    self.max_ns = 0
+
+  def add(self, late_ns):
+    bucket = max(0, late_ns) // (self.bucket_us * 1000)
+    self.counts[min(bucket, len(self.counts) - 1)] += 1
+    self.count += 1
+    self.total_ns += late_ns
+    self.min_ns = late_ns if self.min_ns is None else min(self.min_ns, late_ns)
+    self.max_ns = max(self.max_ns, late_ns)
+
+  def percentile(self, p):
+    # the top of the bucket the percentile falls in, in microseconds
+    target = self.count * p / 100
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= target:
+        return (i + 1) * self.bucket_us if i < len(self.counts) - 1 else self.max_ns / 1000
+    return 0
+
+  def summary(self):
+    return {
+        'count': self.count,
+        'mean_us': self.total_ns / self.count / 1000 if self.count else 0,
+        'min_us': (self.min_ns or 0) / 1000,
+        'p50_us': self.percentile(50),
+        'p99_us': self.percentile(99),
+        'max_us': self.max_ns / 1000,
+        'buckets_us': {i * self.bucket_us: count for i, count in enumerate(self.counts) if count},
+    }
+
+  def __str__(self):
+    s = self.summary()
+    return (f'{s["count"]} sent, late by mean {s["mean_us"]:.1f}us  p50 <{s["p50_us"]:.0f}us  '
+            f'p99 <{s["p99_us"]:.0f}us  max {s["max_us"]:.1f}us')
+
+
+class Scheduler:
+  # runs callbacks at deadlines given in perf_counter_ns nanoseconds
+  # callbacks are called with their deadline and can schedule more work
+  def __init__(self, spin_us=200, clock=time.perf_counter_ns):
+    self.spin_ns = spin_us * 1000
+    self.clock = clock
+    self.queue = []
+    self.counter = itertools.count()
+    self.stats = {}
+    self.running = False
+
+  def now(self):
+    return self.clock()
+
+  def at(self, deadline, kind, callback, *args):
+    # kind names the histogram the lateness of this callback goes into
+    heapq.heappush(self.queue, (deadline, next(self.counter), kind, callback, args))
+
+  def wait_until(self, deadline, until=None):
+    # sleep through most of the wait, then spin so we don't oversleep
+    # until is a perf_counter_ns time to give up at, returning False, however
+    # far the clock moves the deadline while we wait
+    while True:
+      remaining = deadline - self.clock()
+      if remaining <= self.spin_ns:
+        break
+      if until is not None:
+        left = until - time.perf_counter_ns()
+        if left <= 0:
+          return False
+        remaining = min(remaining, left + self.spin_ns)
+      time.sleep((remaining - self.spin_ns) / 1e9)
+    while self.clock() < deadline:
+      if until is not None and time.perf_counter_ns() >= until:
+        return False
+    return True
+
+  def run(self, until=None):
+    # runs until the queue is empty, stop() is called, or perf_counter_ns
+    # reaches until before the next deadline, so the caller can look in
+    # regularly even when the clock jumps away from the deadlines
+    self.running = True
+    while self.running and self.queue:
+      deadline, _, kind, callback, args = self.queue[0]
+      if not self.wait_until(deadline, until):
+        break
+      heapq.heappop(self.queue)
+      if kind not in self.stats:
+        self.stats[kind] = LatenessHistogram()
+      self.stats[kind].add(self.clock() - deadline)
+      callback(deadline, *args)
+    self.running = False
+
+  def cancel(self, kind):
+    # drops everything of kind still to run
+    self.queue = [entry for entry in self.queue if entry[2] != kind]
+    heapq.heapify(self.queue)
+
+  def shift(self, ns):
+    # moves everything still to run ns later (or earlier)
+    self.queue = [(deadline + ns, *rest) for deadline, *rest in self.queue]
+
+  def stop(self):
+    self.running = False
+
+  def report(self):
+    return '\n'.join(f'  {kind}: {stats}' for kind, stats in self.stats.items())
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
+import numpy
+from fractions import Fraction
 from timecode import Timecode
 
 
+def exact_frame_rate(fps):
+  # 29.97 and 23.976 are really 30000/1001 and 24000/1001
+  rounded = round(fps)
+  if abs(fps - rounded) > 0.001:
+    return Fraction(rounded * 1000, 1001)
+  return Fraction(rounded)
+
+
 def bitstring_to_bytes(s, bytecount=1, byteorder='big'):
   return int(s, 2).to_bytes(bytecount, byteorder)
 
@@ -49,61 +59,133 @@ def units_tens(n):
 # ACCORDING TO https://en.wikipedia.org/wiki/Linear_timecode
 # everything is encoded little endian
 # so to encode the number 3 with four bits, we have 1100
+#
+# the 80 bit word is kept as an integer where bit 0 of the
+# frame (frames units) is the most significant bit, so
+# word.to_bytes(10, 'big') gives the bytes in transmission order
+
+# sync word
+LTC_SYNC_WORD = 0b0011111111111101
+
+# little endian bits of every decimal digit
+LTC_DIGIT_BITS = numpy.array([[(d >> k) & 1 for k in range(4)] for d in range(10)], dtype=numpy.uint8)
+
+
+def ltc_bcd_table(units_pos, tens_pos, tens_bits):
+  # precompute the word bits for every two digit value of one field
+  table = []
+  for n in range(100):
+    units, tens = units_tens(n)
+    word = 0
+    for k in range(4):
+      word |= ((units >> k) & 1) << (79 - units_pos - k)
+    for k in range(tens_bits):
+      word |= ((tens >> k) & 1) << (79 - tens_pos - k)
+    table.append(word)
+  return table
+
+
+# frames units / user bits field 1 / frames tens
+# drop frame / color frame / user bits field 2
+LTC_FRAMES = ltc_bcd_table(0, 8, 2)
+# secs units / user bits field 3 / secs tens
+# bit 27 flag / user bits field 4
+LTC_SECS = ltc_bcd_table(16, 24, 3)
+# mins units / user bits field 5 / mins tens
+# bit 43 flag / user bits field 6
+LTC_MINS = ltc_bcd_table(32, 40, 3)
+# hrs units / user bits field 7 / hrs tens
+# bit 58 clock flag / bit 59 flag / user bits field 8
+LTC_HRS = ltc_bcd_table(48, 56, 2)
+
+
+def ltc_word(hrs, mins, secs, frs):
+  return LTC_SYNC_WORD | LTC_FRAMES[frs] | LTC_SECS[secs] | LTC_MINS[mins] | LTC_HRS[hrs]
 
 
 def ltc_encode(timecode, as_string=False):
-  LTC = ''
-  HLP = ''
   hrs, mins, secs, frs = timecode.frames_to_tc(timecode.frames)
-  frame_units, frame_tens = units_tens(frs)
-  secs_units, secs_tens = units_tens(secs)
-  mins_units, mins_tens = units_tens(mins)
-  hrs_units, hrs_tens = units_tens(hrs)
-
-  # frames units / user bits field 1 / frames tens
-  LTC += ble(frame_units, 4) + '0000' + ble(frame_tens, 2)
-  HLP += '---{u}____-{t}'.format(u=frame_units, t=frame_tens)
-
-  # drop frame / color frame / user bits field 2
-  LTC += '00'+'0000'
-  HLP += '__'+'____'
-
-  # secs units / user bits field 3 / secs tens
-  LTC += ble(secs_units, 4) + '0000' + ble(secs_tens, 3)
-  HLP += '---{u}____--{t}'.format(u=secs_units, t=secs_tens)
-
-  # bit 27 flag / user bits field 4
-  LTC += '0' + '0000'
-  HLP += '_' + '____'
-
-  # mins units / user bits field 5 / mins tens
-  LTC += ble(mins_units, 4) + '0000' + ble(mins_tens, 3)
-  HLP += '---{u}____--{t}'.format(u=mins_units, t=mins_tens)
-
-  # bit 43 flag / user bits field 6
-  LTC += '0' + '0000'
-  HLP += '_' + '____'
-
-  # hrs units / user bits field 7 / hrs tens
-  LTC += ble(hrs_units, 4) + '0000' + ble(hrs_tens, 2)
-  HLP += '---{u}____--{t}'.format(u=hrs_units, t=hrs_tens)
-
-  # bit 58 clock flag / bit 59 flag / user bits field 8
-  LTC += '0' + '0' + '0000'
-  HLP += '_' + '_' + '____'
-
-  # sync word
-  LTC += '0011111111111101'
-  HLP += '################'
+  word = ltc_word(hrs, mins, secs, frs)
   if as_string:
-    return LTC
+    return format(word, '080b')
+  else:
+    return word.to_bytes(10, 'big')
+
+
+def frames_to_tc_array(timecode, frames):
+  # same arithmetic as Timecode.frames_to_tc
+  # but for a whole numpy array of frame counts at once
+  ffps = float(timecode.framerate)
+  ifps = round(ffps)
+  if timecode.drop_frame:
+    drop_frames = round(ffps * 0.066666)
   else:
-    return bitstring_to_bytes(LTC, bytecount=10)
+    ffps = float(ifps)
+    drop_frames = 0
+  frames_per_10_minutes = round(ffps * 60 * 10)
+  frames_per_24_hours = round(ffps * 60 * 60 * 24)
+  frames_per_minute = ifps * 60 - drop_frames
+
+  frame_number = (numpy.asarray(frames, dtype=numpy.int64) - 1) % frames_per_24_hours
+  if drop_frames:
+    d = frame_number // frames_per_10_minutes
+    m = frame_number % frames_per_10_minutes
+    frame_number += drop_frames * 9 * d
+    frame_number += numpy.where(m > drop_frames, drop_frames * ((m - drop_frames) // frames_per_minute), 0)
+
+  total_secs = frame_number // ifps
+  return total_secs // 3600, (total_secs // 60) % 60, total_secs % 60, frame_number % ifps
+
+
+def tc_to_frames_array(timecode, hrs, mins, secs, frs):
+  # same arithmetic as Timecode.tc_to_frames, the other way from frames_to_tc_array
+  # returns frame counts (starting at 1, like Timecode.frames) for whole arrays at once
+  ffps = float(timecode.framerate)
+  ifps = round(ffps)
+  drop_frames = round(ffps * 0.066666) if timecode.drop_frame else 0
+  hrs, mins, secs, frs = (numpy.asarray(a, dtype=numpy.int64) for a in (hrs, mins, secs, frs))
+  total_minutes = 60 * hrs + mins
+  frame_number = ifps * 60 * 60 * hrs + ifps * 60 * mins + ifps * secs + frs
+  frame_number -= drop_frames * (total_minutes - total_minutes // 10)
+  return frame_number + 1
+
+
+def ltc_encode_range(start_tc, count, offset=0):
+  # encode `count` consecutive frames beginning `offset` frames after start_tc
+  # returns a (count, 80) array of bits in transmission order
+  frames = start_tc.frames + offset + numpy.arange(count, dtype=numpy.int64)
+  hrs, mins, secs, frs = frames_to_tc_array(start_tc, frames)
+
+  bits = numpy.zeros((count, 80), dtype=numpy.uint8)
+  bits[:, 0:4] = LTC_DIGIT_BITS[frs % 10]
+  bits[:, 8:10] = LTC_DIGIT_BITS[frs // 10, :2]
+  bits[:, 16:20] = LTC_DIGIT_BITS[secs % 10]
+  bits[:, 24:27] = LTC_DIGIT_BITS[secs // 10, :3]
+  bits[:, 32:36] = LTC_DIGIT_BITS[mins % 10]
+  bits[:, 40:43] = LTC_DIGIT_BITS[mins // 10, :3]
+  bits[:, 48:52] = LTC_DIGIT_BITS[hrs % 10]
+  bits[:, 56:58] = LTC_DIGIT_BITS[hrs // 10, :2]
+  bits[:, 64:80] = [(LTC_SYNC_WORD >> (15 - k)) & 1 for k in range(16)]
+  return bits
 
 
 ##
 # MTC functions
 ##
+
+MTC_RATE_FLAGS = {
+    '24':    0,
+    '25':    1,
+    '29.97': 2,
+    '30':    3
+}
+
+# the other way, rate flag to framerate
+MTC_RATES = ['24', '25', '29.97', '30']
+
+MTC_FULL_FRAME_HEADER = bytes([0xf0, 0x7f, 0x7f, 0x01, 0x01])
+
+
 def mtc_encode(timecode, as_string=False):
   # MIDI bytes are little-endian
   # Byte 0
@@ -119,14 +201,7 @@ def mtc_encode(timecode, as_string=False):
   # Byte 3
   #   000fffff: Frame (0–29, or less at lower frame rates)
   hrs, mins, secs, frs = timecode.frames_to_tc(timecode.frames)
-  framerate = timecode.framerate
-  rateflags = {
-      '24':    0,
-      '25':    1,
-      '29.97': 2,
-      '30':    3
-  }
-  rateflag = rateflags[framerate] * 32  # multiply by 32, because the rate flag starts at bit 6
+  rateflag = MTC_RATE_FLAGS[timecode.framerate] * 32  # multiply by 32, because the rate flag starts at bit 6
 
   # print('{:8} {:8} {:8} {:8}'.format(hrs, mins, secs, frs))
   if as_string:
@@ -143,19 +218,64 @@ def mtc_encode(timecode, as_string=False):
     # print(debug_string.format(debug_array))
     return b
 
-# convert a bytearray back to timecode
 
+# nominal frames per second and frames dropped per minute (but not every
+# tenth minute) for each rate flag, so decoding is the same sum at every rate
+MTC_FPS = (24, 25, 30, 30)
+MTC_DROPPED = (0, 0, 2, 0)
+MTC_FPS_ARRAY = numpy.array(MTC_FPS, dtype=numpy.int64)
+MTC_DROPPED_ARRAY = numpy.array(MTC_DROPPED, dtype=numpy.int64)
 
-def mtc_decode(mtc_bytes):
+
+def mtc_frame_number(mtc_bytes):
+  # the frame number (counted from 00:00:00:00) and rate flag of the mtc
+  # bytes, in integers only
   rhh, mins, secs, frs = mtc_bytes
   rateflag = rhh >> 5
-  hrs = rhh & 31
-  fps = ['24', '25', '29.97', '30'][rateflag]
-  total_frames = int(frs + float(fps) * (secs + mins * 60 + hrs * 60 * 60))
-  # total frames must always be an integer above zero
-  if total_frames < 1:
-    total_frames = 1
-  return Timecode(fps, frames=total_frames)
+  total_minutes = 60 * (rhh & 31) + mins
+  frame_number = (60 * total_minutes + secs) * MTC_FPS[rateflag] + frs
+  return frame_number - MTC_DROPPED[rateflag] * (total_minutes - total_minutes // 10), rateflag
+
+
+def mtc_frame_bytes(frame_number, rateflag):
+  # the other way from mtc_frame_number, the mtc bytes of a frame number
+  # (counted from 00:00:00:00) at a rate flag, in integers only
+  fps, dropped = MTC_FPS[rateflag], MTC_DROPPED[rateflag]
+  # no frames are dropped in 144 of the 1440 minutes in a day
+  frame_number %= 86400 * fps - 1296 * dropped
+  if dropped:
+    d, m = divmod(frame_number, 600 * fps - 9 * dropped)
+    frame_number += 9 * dropped * d
+    if m > dropped:
+      frame_number += dropped * ((m - dropped) // (60 * fps - dropped))
+  total_secs, frs = divmod(frame_number, fps)
+  return rateflag << 5 | total_secs // 3600, total_secs // 60 % 60, total_secs % 60, frs
+
+
+def mtc_frame_numbers(records):
+  # mtc_frame_number for a whole array of 4 byte mtc records at once
+  # records can be anything numpy can make an (n, 4) array of, or raw bytes
+  if isinstance(records, (bytes, bytearray, memoryview)):
+    records = numpy.frombuffer(records, dtype=numpy.uint8)
+  records = numpy.asarray(records, dtype=numpy.int64).reshape(-1, 4)
+  rateflags = records[:, 0] >> 5
+  total_minutes = 60 * (records[:, 0] & 31) + records[:, 1]
+  frame_numbers = (60 * total_minutes + records[:, 2]) * MTC_FPS_ARRAY[rateflags] + records[:, 3]
+  frame_numbers -= MTC_DROPPED_ARRAY[rateflags] * (total_minutes - total_minutes // 10)
+  return frame_numbers, rateflags
+
+
+def mtc_frames(mtc_bytes):
+  # the frame count (starting at 1, like Timecode.frames) and framerate of
+  # the mtc bytes, without making a Timecode
+  frame_number, rateflag = mtc_frame_number(mtc_bytes)
+  return frame_number + 1, MTC_RATES[rateflag]
+
+
+# convert a bytearray back to timecode
+def mtc_decode(mtc_bytes):
+  frames, fps = mtc_frames(mtc_bytes)
+  return Timecode(fps, frames=frames)
 
 
 def mtc_full_frame(timecode):
@@ -163,7 +283,7 @@ def mtc_full_frame(timecode):
   # but the full frame timecode bytes are big endian
   mtc_bytes = mtc_encode(timecode)
   # mtc full frame has a special header and ignores the rate flag
-  return bytearray([0xf0, 0x7f, 0x7f, 0x01, 0x01]) + mtc_bytes + bytearray([0xf7])
+  return bytearray(MTC_FULL_FRAME_HEADER) + mtc_bytes + bytearray([0xf7])
 
 
 def mtc_decode_full_frame(full_frame_bytes):
@@ -206,3 +326,148 @@ def mtc_decode_quarter_frames(frame_pieces):
       # 'odd' pieces came from the high nibble
       mtc_bytes[mtc_index] += data * 16
   return mtc_decode(mtc_bytes)
+
+
+class QuarterFrameDecoder:
+  # decodes mtc quarter frames one data byte (piece << 4 | nibble) at a time
+  #
+  # the pieces of a timecode arrive over two frames, 0 to 7 running forward
+  # and 7 to 0 running backward, and only a run of eight in step makes a
+  # timecode; a skipped or repeated piece starts the run again
+  #
+  # update() returns the frame count (starting at 1, like Timecode.frames)
+  # twice a cycle, on the last piece of a timecode and half way through the
+  # next one, otherwise None
+  # the half way count is only given when the half of the next timecode
+  # that has arrived is the one expected, and reset() starts again from
+  # nothing, for when a full frame has moved the timecode somewhere else
+  # running forward the timecode is the frame its first piece went out on,
+  # two frames behind, so the count given is that of the frame the piece
+  # arrived in, and every count arrives three quarters of the way into
+  # its frame (OFFSET)
+  # running backward the counts arrive as their frames start
+  OFFSET = 0.75
+
+  __slots__ = ('nibbles', 'last_piece', 'direction', 'run', 'frames', 'framerate', 'decoded', '_timecode')
+
+  def __init__(self):
+    self.nibbles = [0, 0, 0, 0, 0, 0, 0, 0]
+    self.last_piece = None
+    self.direction = 0  # 1 forward, -1 backward, 0 not known yet
+    self.run = 0  # pieces in a row in step with direction
+    self.frames = None
+    self.framerate = None
+    self.decoded = None  # the frame count the last whole timecode said
+    self._timecode = None
+
+  def reset(self):
+    self.last_piece = None
+    self.direction = 0
+    self.run = 0
+
+  def update(self, value):
+    piece = value >> 4
+    self.nibbles[piece] = value & 15
+    last = self.last_piece
+    self.last_piece = piece
+    if last is None:
+      step = 0
+    else:
+      step = (piece - last) & 7
+      step = 1 if step == 1 else -1 if step == 7 else 0
+    if step == 0:
+      self.direction = 0
+      self.run = 1
+      return None
+    if step != self.direction:
+      self.direction = step
+      self.run = 2
+      return None
+    self.run += 1
+
+    if piece == (7 if step > 0 else 0):
+      # a whole timecode, if all eight pieces are from this run
+      if self.run < 8:
+        return None
+      n = self.nibbles
+      self.decoded, self.framerate = mtc_frames((n[7] << 4 | n[6], n[5] << 4 | n[4], n[3] << 4 | n[2], n[1] << 4 | n[0]))
+      frames = self.decoded + 1 if step > 0 else self.decoded
+    elif piece == (3 if step > 0 else 4):
+      # half way through the next timecode, which is two frames on (or back)
+      # from the last one, if the run goes all the way back to it and the
+      # pieces of the next timecode so far agree
+      if self.run < 12:
+        return None
+      n = self.nibbles
+      rhh, mins, secs, frs = mtc_frame_bytes(self.decoded - 1 + 2 * step, MTC_RATE_FLAGS[self.framerate])
+      if step > 0:
+        if (n[3] << 4 | n[2], n[1] << 4 | n[0]) != (secs, frs):
+          return None
+        frames = self.decoded + 2
+      else:
+        if (n[7] << 4 | n[6], n[5] << 4 | n[4]) != (rhh, mins):
+          return None
+        frames = self.decoded - 1
+    else:
+      return None
+    self.frames = frames
+    self._timecode = None
+    return frames
+
+  @property
+  def timecode(self):
+    # a Timecode for the current frames, only made when asked for
+    if self._timecode is None and self.frames is not None:
+      self._timecode = Timecode(self.framerate, frames=self.frames)
+    return self._timecode
+
+
+class MtcFrameTable:
+  # every mtc message for a run of frames, worked out all at once
+  # the realtime loop only has to find the right slice and send it
+  #
+  # mtc:            4 bytes per frame, the same as mtc_encode
+  # quarter_frames: 8 two byte messages per frame, the same as mtc_quarter_frame
+  # full_frames:    10 bytes per frame, the same as mtc_full_frame
+  def __init__(self, start_tc, count):
+    self.start = start_tc.frames
+    self.count = count
+    frames = self.start + numpy.arange(count, dtype=numpy.int64)
+    hrs, mins, secs, frs = frames_to_tc_array(start_tc, frames)
+
+    mtc = numpy.empty((count, 4), dtype=numpy.uint8)
+    mtc[:, 0] = MTC_RATE_FLAGS[start_tc.framerate] * 32 + hrs
+    mtc[:, 1] = mins
+    mtc[:, 2] = secs
+    mtc[:, 3] = frs
+
+    # piece n carries the low (even n) or high (odd n) nibble of byte 3 - n//2
+    pieces = numpy.arange(8)
+    data = mtc[:, 3 - pieces // 2]
+    quarter_frames = numpy.empty((count, 8, 2), dtype=numpy.uint8)
+    quarter_frames[:, :, 0] = 0xf1
+    quarter_frames[:, :, 1] = pieces * 16 + numpy.where(pieces % 2 == 0, data & 15, data >> 4)
+
+    full_frames = numpy.empty((count, 10), dtype=numpy.uint8)
+    full_frames[:, :5] = numpy.frombuffer(MTC_FULL_FRAME_HEADER, dtype=numpy.uint8)
+    full_frames[:, 5:9] = mtc
+    full_frames[:, 9] = 0xf7
+
+    self.mtc = memoryview(mtc.tobytes())
+    self.quarter_frames = memoryview(quarter_frames.tobytes())
+    self.full_frames = memoryview(full_frames.tobytes())
+
+  def __contains__(self, frames):
+    return 0 <= frames - self.start < self.count
+
+  def mtc_bytes(self, frames):
+    i = (frames - self.start) * 4
+    return self.mtc[i:i + 4]
+
+  def quarter_frame(self, frames, piece):
+    i = (frames - self.start) * 16 + piece * 2
+    return self.quarter_frames[i:i + 2]
+
+  def full_frame(self, frames):
+    i = (frames - self.start) * 10
+    return self.full_frames[i:i + 10]
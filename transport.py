@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# MIDI ports that move raw bytes
+#
+# sending takes anything that iterates over byte values (bytes, lists,
+# the memoryview slices from tools.MtcFrameTable) and receiving hands back
+# bytes with the perf_counter_ns time they arrived, so nothing has to be
+# turned into a mido.Message on the way through
+#
+# backends:
+#   rtmidi   -- python-rtmidi directly, the fast path
+#   mido     -- whatever mido is set up to use, when python-rtmidi isn't there
+#   loopback -- in memory, outputs feed inputs of the same name, no hardware needed
+
+import collections
+import queue
+import threading
+import time
+
+import mido
+
+from scheduler import LatenessHistogram
+
+# python-rtmidi is optional, mido is used without it
+try:
+  import rtmidi
+except ImportError:
+  rtmidi = None
+
+
+class Input:
+  # messages are delivered to callback(data, timestamp) if there is one
+  # and queued for poll() if there isn't
+  def __init__(self, name, callback=None):
+    self.name = name
+    self.callback = callback
+    self.queue = collections.deque()
+
+  def deliver(self, data, timestamp):
+    callback = self.callback
+    if callback is not None:
+      callback(data, timestamp)
+    else:
+      self.queue.append((data, timestamp))
+
+  def poll(self):
+    # returns (data, timestamp) or None
+    return self.queue.popleft() if self.queue else None
+
+  def close(self):
+    pass
+
+
+class RtMidiInput(Input):
+  def __init__(self, name, callback=None):
+    super().__init__(name, callback)
+    self.port = rtmidi.MidiIn()
+    self.port.open_port(port_index(self.port.get_ports(), name))
+    # rtmidi drops sysex and timing messages unless asked, and mtc is both
+    self.port.ignore_types(sysex=False, timing=False, active_sense=True)
+    self.port.set_callback(self.on_message)
+
+  def on_message(self, event, data=None):
+    self.deliver(bytes(event[0]), time.perf_counter_ns())
+
+  def close(self):
+    self.port.cancel_callback()
+    self.port.close_port()
+
+
+class MidoInput(Input):
+  def __init__(self, name, callback=None):
+    super().__init__(name, callback)
+    self.port = mido.open_input(name, callback=self.on_message)
+
+  def on_message(self, msg):
+    self.deliver(bytes(msg.bytes()), time.perf_counter_ns())
+
+  def close(self):
+    self.port.close()
+
+
+class RtMidiOutput:
+  def __init__(self, name):
+    self.name = name
+    self.port = rtmidi.MidiOut()
+    self.port.open_port(port_index(self.port.get_ports(), name))
+
+  def send(self, data):
+    self.port.send_message(data)
+
+  def close(self):
+    self.port.close_port()
+
+
+class MidoOutput:
+  def __init__(self, name):
+    self.name = name
+    self.port = mido.open_output(name)
+
+  def send(self, data):
+    self.port.send(mido.Message.from_bytes(data))
+
+  def close(self):
+    self.port.close()
+
+
+class FanOutOutput:
+  # sends every message to several outputs, each one from its own thread,
+  # so a slow port only ever holds itself up
+  # the histograms time each message from send() until its port is done with it
+  def __init__(self, outputs):
+    self.outputs = outputs
+    self.name = ', '.join(output.name for output in outputs)
+    self.queues = [queue.SimpleQueue() for output in outputs]
+    self.stats = {output.name: LatenessHistogram() for output in outputs}
+    self.threads = []
+    for output, q in zip(outputs, self.queues):
+      thread = threading.Thread(target=self.do_thread, args=(output, q, self.stats[output.name]), daemon=True)
+      thread.start()
+      self.threads.append(thread)
+
+  def send(self, data):
+    timestamp = time.perf_counter_ns()
+    for q in self.queues:
+      q.put((data, timestamp))
+
+  def do_thread(self, output, q, stats):
+    while True:
+      item = q.get()
+      if item is None:
+        return
+      data, timestamp = item
+      output.send(data)
+      stats.add(time.perf_counter_ns() - timestamp)
+
+  def close(self):
+    # anything already queued still goes out
+    for q in self.queues:
+      q.put(None)
+    for thread in self.threads:
+      thread.join()
+    for output in self.outputs:
+      output.close()
+
+  def report(self):
+    return '\n'.join(f'  {name}: {stats}' for name, stats in self.stats.items())
+
+
+# loopback ports are matched up by name
+loopback_inputs = collections.defaultdict(list)
+
+
+class LoopbackInput(Input):
+  def __init__(self, name, callback=None):
+    super().__init__(name, callback)
+    loopback_inputs[name].append(self)
+
+  def close(self):
+    loopback_inputs[self.name].remove(self)
+
+
+class LoopbackOutput:
+  def __init__(self, name):
+    self.name = name
+    self.sent = 0
+
+  def send(self, data):
+    timestamp = time.perf_counter_ns()
+    data = bytes(data)
+    for port in loopback_inputs[self.name]:
+      port.deliver(data, timestamp)
+    self.sent += 1
+
+  def close(self):
+    pass
+
+
+def port_index(names, name):
+  if name in names:
+    return names.index(name)
+  # rtmidi names carry client numbers that can change, so a prefix will do
+  for i, port_name in enumerate(names):
+    if port_name.startswith(name):
+      return i
+  raise IOError(f'unknown MIDI port: {name}')
+
+
+def pick_backend(name=None, backend=None):
+  if backend is not None:
+    return backend
+  if name is not None and name.startswith('loopback'):
+    return 'loopback'
+  return 'rtmidi' if rtmidi is not None else 'mido'
+
+
+def open_input(name, callback=None, backend=None):
+  backend = pick_backend(name, backend)
+  if backend == 'loopback':
+    return LoopbackInput(name, callback)
+  if backend == 'rtmidi':
+    return RtMidiInput(name, callback)
+  return MidoInput(name, callback)
+
+
+def open_output(name, backend=None):
+  backend = pick_backend(name, backend)
+  if backend == 'loopback':
+    return LoopbackOutput(name)
+  if backend == 'rtmidi':
+    return RtMidiOutput(name)
+  return MidoOutput(name)
+
+
+def open_outputs(names, backend=None):
+  # one name gives a plain output, more than one share a fan out
+  if len(names) == 1:
+    return open_output(names[0], backend)
+  return FanOutOutput([open_output(name, backend) for name in names])
+
+
+def unique(names):
+  # some systems list the same port more than once
+  return list(dict.fromkeys(names))
+
+
+def get_input_names(backend=None):
+  backend = pick_backend(backend=backend)
+  if backend == 'loopback':
+    return list(loopback_inputs)
+  if backend == 'rtmidi':
+    return unique(rtmidi.MidiIn().get_ports())
+  return unique(mido.get_input_names())
+
+
+def get_output_names(backend=None):
+  backend = pick_backend(backend=backend)
+  if backend == 'loopback':
+    return list(loopback_inputs)
+  if backend == 'rtmidi':
+    return unique(rtmidi.MidiOut().get_ports())
+  return unique(mido.get_output_names())